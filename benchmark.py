@@ -0,0 +1,214 @@
+import argparse
+import json
+import multiprocessing
+import operator
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+try:
+    # https://github.com/RobertBoganKang/file_processing
+    from file_processing import FileProcessing
+except Exception:
+    raise ImportError('ERROR: cannot import!')
+
+
+class NoOperation(FileProcessing):
+    """
+    only create an empty output for each file, to measure the overhead of framework
+    """
+
+    def do(self, in_path, out_path):
+        open(out_path, 'w').close()
+
+
+class Benchmark(object):
+    """
+    benchmark of file searching and processing dispatch on synthetic file systems
+    """
+
+    def __init__(self, ops):
+        self.file_number = ops.file_number
+        self.huge_file_number = ops.huge_file_number
+        self.huge_file_size = ops.huge_file_size
+        self.cpu_number = ops.cpu_number
+        self.trees = ops.trees
+        self.stages = ops.stages
+        self.output = ops.output
+        self.root = None
+        self.results = []
+
+    def __call__(self):
+        self.root = tempfile.mkdtemp(prefix='fp_benchmark_')
+        try:
+            for tree in self.trees:
+                tree_folder = os.path.join(self.root, tree)
+                file_number = self._generate_tree(tree, tree_folder)
+                self._run_tree(tree, tree_folder, file_number)
+        finally:
+            shutil.rmtree(self.root, ignore_errors=True)
+        self._report()
+
+    def _generate_tree(self, tree, folder):
+        """
+        generate synthetic file system
+        :return: int; the number of `txt` files
+        """
+        if tree == 'flat':
+            # all files in one folder
+            paths = [os.path.join(folder, f'{i}.txt') for i in range(self.file_number)]
+            sizes = [16] * len(paths)
+        elif tree == 'deep':
+            # 8 levels of folders, 4 files for each leaf folder
+            paths = []
+            for i in range(self.file_number):
+                leaf = i // 4
+                parts = [f'd{(leaf >> (2 * x)) & 3}' for x in range(8)]
+                paths.append(os.path.join(folder, *parts, f'{i}.txt'))
+            sizes = [16] * len(paths)
+        elif tree == 'small':
+            # many small files in balanced folders, mixed with other formats
+            paths = [os.path.join(folder, f'{i % 100}', f'{i}.{"txt" if i % 4 else "dat"}')
+                     for i in range(self.file_number)]
+            sizes = [1] * len(paths)
+        elif tree == 'huge':
+            # a few huge files
+            paths = [os.path.join(folder, f'{i}.txt') for i in range(self.huge_file_number)]
+            sizes = [self.huge_file_size] * len(paths)
+        else:
+            raise ValueError(f'ERROR: unknown tree `{tree}`!')
+        block = b'x' * (1 << 20)
+        for path, size in zip(paths, sizes):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                while size > 0:
+                    f.write(block[:size])
+                    size -= len(block)
+        return sum(x.endswith('.txt') for x in paths)
+
+    def _run_tree(self, tree, folder, file_number):
+        ops = {'input': folder, 'in_format': 'txt', 'cpu_number': self.cpu_number}
+        if 'find' in self.stages:
+            for in_format in ['txt', '\\.txt$', '^*.txt', '!']:
+                ops_format = dict(ops, in_format=in_format)
+                self._run_stage(tree, f'find_fs [{in_format}]', _stage_find_fs, (ops_format,))
+                self._run_stage(tree, f'find_fs_iterator [{in_format}]', _stage_find_fs_iterator, (ops_format,))
+        if 'read' in self.stages:
+            list_path = os.path.join(self.root, f'{tree}.list')
+            with open(list_path, 'w') as f:
+                f.writelines(x + '\n' for x in FileProcessing(ops).fp_paths)
+            self._run_stage(tree, 'read_fs', _stage_read_fs, (dict(ops, input=list_path),))
+        if 'operator' in self.stages:
+            for name, function in [('|', operator.or_), ('&', operator.and_), ('-', operator.sub), ('^', operator.xor)]:
+                self._run_stage(tree, f'operator [{name}]', _stage_operator, (ops, function))
+        if 'dispatch' in self.stages:
+            output = os.path.join(self.root, f'{tree}_output')
+            for multi_what in ['serial', 'mp', 'mt', 'imp', 'imt', 'mpt', 'impt', 'async', 'iasync']:
+                ops_dispatch = dict(ops, output=output, out_format='out')
+                if multi_what == 'serial':
+                    ops_dispatch['cpu_number'] = 1
+                else:
+                    ops_dispatch['multi_what'] = multi_what
+                self._run_stage(tree, f'dispatch [{multi_what}]', _stage_dispatch, (ops_dispatch,), file_number)
+                shutil.rmtree(output, ignore_errors=True)
+
+    def _run_stage(self, tree, stage, function, args, file_number=None):
+        """ run stage within a new process, to measure its peak memory """
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_measure, args=(sender, function, args))
+        process.start()
+        # the sender is used by the stage process only, then its failure can be found
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            raise RuntimeError(f'ERROR: stage `{stage}` failed!')
+        finally:
+            process.join()
+        if file_number is not None:
+            result['files'] = file_number
+        result['files_per_second'] = result['files'] / result['seconds'] if result['seconds'] > 0 else 0
+        result.update({'tree': tree, 'stage': stage})
+        self.results.append(result)
+        print(f'{tree:>6s} | {stage:<28s} | {result["files"]:>8d} files | {result["seconds"]:>8.3f} s | '
+              f'{result["files_per_second"]:>10.0f} files/s | {result["peak_rss"] / 1024:>8.1f} MB')
+
+    def _report(self):
+        if self.output is not None:
+            with open(self.output, 'w') as f:
+                json.dump(self.results, f, indent=2)
+
+
+def _peak_rss():
+    """ peak memory (KB) of the process and its children """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _measure(sender, function, args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start_time
+    # the stage can measure the time itself
+    if not isinstance(result, dict):
+        result = {'files': result, 'seconds': seconds}
+    result['peak_rss'] = _peak_rss()
+    sender.send(result)
+
+
+def _stage_find_fs(ops):
+    return len(FileProcessing(ops).fp_paths)
+
+
+def _stage_find_fs_iterator(ops):
+    fp = FileProcessing(dict(ops, multi_what='imp'))
+    return sum(1 for _ in fp._find_fs_iterator())
+
+
+def _stage_read_fs(ops):
+    return len(FileProcessing(ops).fp_paths)
+
+
+def _stage_operator(ops, function):
+    fp_all = FileProcessing(ops)
+    fp_half = FileProcessing(ops)
+    fp_half.fp_paths = fp_half.fp_paths[::2]
+    # only measure the operator
+    start_time = time.perf_counter()
+    result = function(fp_all, fp_half)
+    len(result.fp_paths)
+    return {'files': len(fp_all.fp_paths) + len(fp_half.fp_paths), 'seconds': time.perf_counter() - start_time}
+
+
+def _stage_dispatch(ops):
+    # hide progress bar
+    with open(os.devnull, 'w') as devnull:
+        stderr = sys.stderr
+        sys.stderr = devnull
+        try:
+            NoOperation(ops)()
+        finally:
+            sys.stderr = stderr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark of file searching and processing dispatch')
+    parser.add_argument('--file_number', '-n', type=int, help='the number of files for each tree', default=10000)
+    parser.add_argument('--huge_file_number', type=int, help='the number of files for `huge` tree', default=4)
+    parser.add_argument('--huge_file_size', type=int, help='the size (bytes) of file for `huge` tree',
+                        default=64 * 1024 * 1024)
+    parser.add_argument('--cpu_number', '-j', type=int, help='cpu number of processing', default=0)
+    parser.add_argument('--trees', '-t', type=str, nargs='+', help='synthetic trees: `flat`, `deep`, `small`, `huge`',
+                        default=['flat', 'deep', 'small', 'huge'])
+    parser.add_argument('--stages', '-s', type=str, nargs='+',
+                        help='stages: `find`, `read`, `operator`, `dispatch`',
+                        default=['find', 'read', 'operator', 'dispatch'])
+    parser.add_argument('--output', '-o', type=str, help='save the results as json file')
+    args = parser.parse_args()
+
+    Benchmark(args)()
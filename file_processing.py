@@ -1,18 +1,38 @@
+import asyncio
+import atexit
 import concurrent.futures
+import cProfile
+import csv
+import fnmatch
 import functools
-import glob
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import logging.handlers
+import multiprocessing.connection
+import multiprocessing.util
 import operator
 import os
 import pathlib
+import pickle
+import pstats
+import queue
 import re
 import shutil
 import signal
+import socket
+import tempfile
+import threading
 import time
+import traceback
+import zlib
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from copy import copy
-from inspect import signature
+from inspect import signature, iscoroutinefunction, isawaitable
+from types import SimpleNamespace
 
-import numpy as np
 from tqdm import tqdm
 
 
@@ -41,19 +61,604 @@ def timeout(seconds):
     return decorated
 
 
+# the processing object of the worker process, it will be sent only once when the worker starts
+_worker_fp_obj = None
+# the threads within worker process for hybrid modes `mpt` and `impt`
+_worker_thread_pool = None
+# the state of each worker (process or thread)
+_worker_local = threading.local()
+# only one profiler can be active in a process (`sys.monitoring` from Python 3.12), it is owned by the first thread
+_profiler_lock = threading.Lock()
+
+
+class _WorkerThreadPool(ThreadPoolExecutor):
+    """
+    the threads of workers: `before_worker` and `after_worker` run within each thread (such as the thread-bound
+    connection), the threads finalize before shutdown.
+    """
+
+    def __init__(self, max_workers, fp_obj):
+        super().__init__(max_workers=max_workers, initializer=fp_obj._start_worker)
+        self.fp_obj = fp_obj
+        self.is_stopped = False
+
+    def shutdown(self, wait=True, **kwargs):
+        if not self.is_stopped and not self._broken and self._threads:
+            self.is_stopped = True
+            # each thread takes one finalizing task, since the tasks wait for each other
+            # --> no more thread is started for the finalizing tasks
+            self._max_workers = len(self._threads)
+            barrier = threading.Barrier(len(self._threads))
+            futures = [self.submit(self.fp_obj._stop_worker, barrier) for _ in range(len(self._threads))]
+            concurrent.futures.wait(futures)
+        super().shutdown(wait=wait, **kwargs)
+
+
+def _initialize_worker(fp_obj):
+    """ keep the processing object within worker process """
+    global _worker_fp_obj
+    _worker_fp_obj = fp_obj
+    fp_obj._connect_logger()
+    fp_obj._start_worker()
+    # finalize when the worker process exits
+    multiprocessing.util.Finalize(None, fp_obj._stop_workers, exitpriority=10)
+
+
+def _do_batch_chunk(paths, submit_time=None):
+    """ process a batch of paths with `do_batch` within worker process """
+    return _worker_fp_obj._do_batch_task(paths, submit_time)
+
+
+def _do_pipeline_stage(stage, *args):
+    """ run a stage of pipeline within worker process """
+    return _worker_fp_obj._do_stage(stage, *args)
+
+
+def _initialize_hybrid_worker(fp_obj, thread_number):
+    """ keep the processing object and its threads within worker process """
+    global _worker_fp_obj, _worker_thread_pool
+    _worker_fp_obj = fp_obj
+    fp_obj._connect_logger()
+    _worker_thread_pool = _WorkerThreadPool(thread_number, fp_obj)
+    # finalize when the worker process exits: the threads exit first (higher priority), then the workers finalize
+    multiprocessing.util.Finalize(None, fp_obj._stop_workers, exitpriority=10)
+    multiprocessing.util.Finalize(None, _worker_thread_pool.shutdown, exitpriority=20)
+
+
+def _do_multi_mapping_chunk(paths, submit_time=None):
+    """ process a chunk of paths within worker process """
+    return [_worker_fp_obj._do_task(x, submit_time=submit_time) for x in paths]
+
+
+def _do_multi_mapping_chunk_threaded(paths, submit_time=None):
+    """ process a chunk of paths by the threads within worker process """
+    return list(_worker_thread_pool.map(functools.partial(_worker_fp_obj._do_task, submit_time=submit_time), paths))
+
+
+def _run_supervised_worker(connection, fp_obj, is_process):
+    """ worker of supervised pool: process the received paths one by one until `None` """
+    if is_process:
+        _initialize_worker(fp_obj)
+    else:
+        fp_obj._start_worker()
+    while True:
+        try:
+            in_path = connection.recv()
+        except (EOFError, OSError):
+            break
+        if in_path is None:
+            break
+        try:
+            connection.send(fp_obj._do_task(in_path, retry=False))
+        except OSError:
+            # the worker has been abandoned by timeout
+            break
+    if not is_process:
+        # finalize within the thread, the process is finalized at exit
+        fp_obj._stop_worker()
+
+
+class _SupervisedWorker(object):
+    """ a worker (process or thread) with its own connection, it can be replaced if stuck """
+
+    def __init__(self, fp_obj, is_process):
+        self.is_process = is_process
+        self.connection, child_connection = multiprocessing.Pipe()
+        worker_class = multiprocessing.Process if is_process else threading.Thread
+        self.worker = worker_class(target=_run_supervised_worker, args=(child_connection, fp_obj, is_process),
+                                   daemon=not is_process)
+        self.worker.start()
+        if is_process:
+            # the connection is used by child process only, then the exit of child can be found
+            child_connection.close()
+        self.task = None
+        self.deadline = None
+
+    def submit(self, task, timeout_seconds):
+        """ task: (in_path, attempt) """
+        self.task = task
+        self.deadline = time.time() + timeout_seconds
+        self.connection.send(task[0])
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.worker.join()
+
+    def kill(self):
+        """ kill the process, the thread cannot be killed but abandoned """
+        if self.is_process:
+            self.worker.kill()
+            self.worker.join()
+        self.connection.close()
+
+
+class _PathRecord(object):
+    """
+    append-only record file: one line for one path, with tab-separated fields after path
+    --> records are buffered and flushed by number or interval, not synchronized for each line.
+    """
+
+    def __init__(self, record_path, flush_number=1000, flush_interval=5):
+        self.record_path = record_path
+        self.flush_number = flush_number
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush_time = time.time()
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self):
+        """
+        read the records, the later record of the same path will cover the former one
+        :return: dict; {path: fields}
+        """
+        records = {}
+        if not os.path.isfile(self.record_path):
+            return records
+        with open(self.record_path, 'r', encoding='utf-8', newline='\n') as f:
+            for line in f:
+                # the last line may be incomplete if interrupted
+                if not line.endswith('\n'):
+                    break
+                fields = line[:-1].split('\t')
+                records[fields[0]] = fields[1:]
+        return records
+
+    def add(self, path, *fields):
+        with self._lock:
+            self._buffer.append('\t'.join([path] + [str(x) for x in fields]) + '\n')
+            if len(self._buffer) >= self.flush_number or time.time() - self._last_flush_time > self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.record_path), exist_ok=True)
+            self._file = open(self.record_path, 'a', encoding='utf-8', newline='\n')
+        self._file.writelines(self._buffer)
+        self._file.flush()
+        self._buffer = []
+        self._last_flush_time = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._buffer:
+                self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class _PathMatcher(object):
+    """
+    match the file name (or the last parts of path) with the patterns of `in_format`:
+    --> extension (such as `txt`), regular expression (starts with `\\`), or glob (starts with `^`);
+    --> the extensions are matched by set, the patterns are compiled once.
+    """
+
+    def __init__(self, patterns):
+        self.extensions = set()
+        self.regexes = []
+        self.name_globs = []
+        self.path_globs = []
+        for pattern in patterns:
+            if pattern.startswith('\\'):
+                self.regexes.append(re.compile(pattern[1:]))
+            elif pattern.startswith('^'):
+                parts = pattern[1:].split('/')
+                if len(parts) == 1:
+                    self.name_globs.append(re.compile(fnmatch.translate(parts[0])))
+                else:
+                    # glob pattern `**/<pattern>`: match the last parts of relative path
+                    self.path_globs.append([re.compile(fnmatch.translate(x)) for x in parts])
+            else:
+                self.extensions.add(pattern)
+        # the extension may have several parts, such as `tar.gz`
+        self.extension_part_number = max([x.count('.') + 1 for x in self.extensions], default=0)
+
+    def match_extension(self, name):
+        """
+        get the matched extension of the file name
+        :return: str; the longest matched extension, `None` if not matched
+        """
+        matched = None
+        index = len(name)
+        for _ in range(self.extension_part_number):
+            index = name.rfind('.', 0, index)
+            if index < 0:
+                break
+            if name[index + 1:] in self.extensions:
+                matched = name[index + 1:]
+        return matched
+
+    def match(self, path, name):
+        if self.extensions and self.match_extension(name) is not None:
+            return True
+        for regex in self.name_globs:
+            if regex.match(name) is not None:
+                return True
+        for regex in self.regexes:
+            if regex.search(name) is not None:
+                return True
+        if self.path_globs:
+            path_parts = path.split(os.sep)
+            for parts in self.path_globs:
+                if len(path_parts) >= len(parts) and all(
+                        y.match(x) is not None for x, y in zip(path_parts[-len(parts):], parts)):
+                    return True
+        return False
+
+
+class _DedupCache(object):
+    """
+    content-addressed cache of outputs: the output of identical input (by content hash) is reused
+    --> the cache is a folder of output files named by key, evicted by least recently used when too large.
+    """
+
+    def __init__(self, cache_folder, max_size, context, link=True, block_size=1 << 20):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        # the output also depends on class, version and output format
+        self.context = context.encode('utf-8')
+        self.link = link
+        self.block_size = block_size
+
+    def get_key(self, in_path):
+        """ streaming hash of context and file content """
+        hasher = hashlib.blake2b(self.context, digest_size=20)
+        with open(in_path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    def _get_cache_path(self, key):
+        return os.path.join(self.cache_folder, key[:2], key)
+
+    def restore(self, key, out_path):
+        """
+        restore the cached output by hard link (or copy)
+        :return: bool; the output is restored
+        """
+        cache_path = self._get_cache_path(key)
+        if not os.path.isfile(cache_path):
+            return False
+        if os.path.isfile(out_path) and os.path.samefile(cache_path, out_path):
+            # already linked
+            os.utime(cache_path)
+            return True
+        temp_path = f'{out_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            if self.link:
+                try:
+                    os.link(cache_path, temp_path)
+                except OSError:
+                    # such as different devices
+                    shutil.copyfile(cache_path, temp_path)
+            else:
+                shutil.copyfile(cache_path, temp_path)
+            os.replace(temp_path, out_path)
+            # refresh for eviction
+            os.utime(cache_path)
+        except OSError:
+            # the cache may be evicted by other process
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
+
+    @staticmethod
+    def prepare(out_path):
+        """ the linked output should not be rewritten in place, otherwise the cache will be changed """
+        try:
+            if os.stat(out_path).st_nlink > 1:
+                os.remove(out_path)
+        except OSError:
+            pass
+
+    def store(self, key, out_path):
+        """ store the output (only single file) into cache by hard link (or copy), without writing it again """
+        if not os.path.isfile(out_path):
+            return
+        cache_path = self._get_cache_path(key)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if self.link:
+            try:
+                os.link(out_path, temp_path)
+            except OSError:
+                # such as different devices
+                shutil.copyfile(out_path, temp_path)
+        else:
+            shutil.copyfile(out_path, temp_path)
+        os.replace(temp_path, cache_path)
+
+    def evict(self):
+        """ remove the least recently used outputs if the cache is too large """
+        if self.max_size <= 0 or not os.path.isdir(self.cache_folder):
+            return
+        entries = []
+        total_size = 0
+        for folder in os.scandir(self.cache_folder):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+
+class _WorkerTuner(object):
+    """
+    tune the number of active workers by hill climbing on the throughput (files per second) of each interval
+    --> move on (faster for growing) while the throughput increases, otherwise turn back with smaller step,
+        then settle at the best;
+    --> not grow if CPU is saturated, and shrink at once if the available memory is lower than the reserve;
+    --> the memory and CPU are sampled at most once for each interval.
+    """
+
+    def __init__(self, max_number, start_number, interval, memory_reserve):
+        try:
+            import psutil
+        except ImportError:
+            psutil = None
+        self.psutil = psutil
+        self.max_number = max_number
+        self.number = max(min(start_number, max_number), 1)
+        self.interval = interval
+        self.memory_reserve = memory_reserve
+        self.step = max(self.number // 4, 1)
+        self.direction = 1
+        self.lock = threading.Lock()
+        self.done = 0
+        self.window_done = 0
+        self.window_time = self.sample_time = time.perf_counter()
+        self.last_throughput = None
+        self.settled_throughput = None
+        self.best = (0, self.number)
+        # history: (number of active workers, throughput, CPU percent, available memory fraction)
+        self.history = []
+        if self.psutil is not None:
+            # the first call of CPU percent is meaningless
+            self.psutil.cpu_percent()
+
+    def add(self, number):
+        """ add the number of finished files """
+        with self.lock:
+            self.done += number
+
+    def get_cpu_percent(self):
+        """ system CPU utilisation since last call, `None` if `psutil` is not installed """
+        if self.psutil is None:
+            return None
+        return self.psutil.cpu_percent()
+
+    def get_memory(self):
+        """
+        the available and total memory of system
+        :return: (int, int); bytes, `None` if unknown
+        """
+        if self.psutil is not None:
+            memory = self.psutil.virtual_memory()
+            return memory.available, memory.total
+        try:
+            with open('/proc/meminfo') as f:
+                memory = dict(x.split(':', 1) for x in f)
+            return int(memory['MemAvailable'].split()[0]) * 1024, int(memory['MemTotal'].split()[0]) * 1024
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def get_available_memory(self):
+        """ the fraction of available memory, `None` if unknown """
+        memory = self.get_memory()
+        if memory is None:
+            return None
+        return memory[0] / memory[1]
+
+    def get_process_memory(self):
+        """ the resident memory (bytes) of current process, `None` if unknown """
+        if self.psutil is not None:
+            return self.psutil.Process().memory_info().rss
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def limit_by_memory(self, worker_memory):
+        """ limit the maximum number by the memory of each worker, to keep the reserve of available memory """
+        memory = self.get_memory()
+        if memory is None or not worker_memory:
+            return
+        available, total = memory
+        number = int((available - total * self.memory_reserve) // worker_memory)
+        self.max_number = max(min(self.max_number, number), 1)
+        self.number = min(self.number, self.max_number)
+        self.best = (0, self.number)
+
+    def update(self):
+        """
+        measure the throughput at the end of each interval, then tune
+        :return: int; the number of active workers
+        """
+        now = time.perf_counter()
+        # called for each task: sample the memory and CPU at most once for each interval
+        if now - self.sample_time < self.interval:
+            return self.number
+        self.sample_time = now
+        available = self.get_available_memory()
+        if available is not None and available < self.memory_reserve and self.number > 1:
+            # memory pressure: shrink at once, and not grow beyond it again
+            self.number = self.max_number = max(self.number // 2, 1)
+            self._start_window(now)
+            return self.number
+        if self.done == self.window_done:
+            return self.number
+        elapsed = now - self.window_time
+        throughput = (self.done - self.window_done) / elapsed
+        cpu = self.get_cpu_percent()
+        self.history.append((self.number, throughput, cpu, available))
+        if throughput > self.best[0]:
+            self.best = (throughput, self.number)
+        if self.step == 0:
+            # settled: explore again if the throughput drops a lot (such as the files are changed)
+            if throughput < self.settled_throughput * 0.8:
+                self.step = max(self.number // 4, 1)
+                self.best = (throughput, self.number)
+        elif self.last_throughput is not None and throughput < self.last_throughput * 1.05:
+            # not better: turn back with smaller step, or settle at the best
+            if self.step == 1:
+                self.step = 0
+                self.number = self.best[1]
+                self.settled_throughput = self.best[0]
+            else:
+                self.direction = -self.direction
+                self.step //= 2
+        elif self.last_throughput is not None and self.direction > 0:
+            # better: grow faster
+            self.step *= 2
+        if self.step > 0:
+            is_limited = (cpu is not None and cpu >= 95) or (
+                    available is not None and available < self.memory_reserve * 2)
+            if self.direction > 0 and is_limited:
+                self.direction = -1
+            number = min(max(self.number + self.direction * self.step, 1), self.max_number)
+            if number == self.number:
+                self.direction = -self.direction
+            self.number = number
+        self.last_throughput = throughput
+        self._start_window(now)
+        return self.number
+
+    def _start_window(self, now):
+        self.window_done = self.done
+        self.window_time = now
+
+    def get_summary(self):
+        return {
+            'active_worker_number': self.number,
+            'max_worker_number': self.max_number,
+            'best_worker_number': self.best[1],
+            'best_files_per_second': self.best[0],
+            'history': [{'active_worker_number': x[0], 'files_per_second': x[1], 'cpu_percent': x[2],
+                         'available_memory': x[3]} for x in self.history],
+        }
+
+
+# the queue of log records from workers (processes or threads), and its listener within main process
+_log_queue = None
+_log_listener = None
+
+
+class _LogHandler(logging.handlers.RotatingFileHandler):
+    """
+    rotating file handler for the listener of log records
+    --> the records are not flushed one by one, the listener flushes once for each batch.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, 'a', max_bytes, backup_count, encoding='utf-8')
+        self._size = self.stream.tell()
+
+    def emit(self, record):
+        try:
+            message = self.format(record) + self.terminator
+            if self.maxBytes > 0 and self._size > 0 and self._size + len(message) >= self.maxBytes:
+                self.doRollover()
+                self._size = 0
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(message)
+            self._size += len(message)
+        except Exception:
+            self.handleError(record)
+
+
+class _LogListener(logging.handlers.QueueListener):
+    """
+    listener of log records within main process
+    --> the waiting records are handled as a batch, then flushed once.
+    """
+
+    def __init__(self, log_queue, handler, batch_size=1000):
+        super().__init__(log_queue, handler)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        while True:
+            records = [self.dequeue(True)]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            for record in records:
+                if record is self._sentinel:
+                    self._flush()
+                    return
+                self.handle(record)
+            self._flush()
+
+    def _flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+
 def initialize_logger(logger_level='info'):
-    import logging
-    from concurrent_log_handler import ConcurrentRotatingFileHandler
+    """
+    the log records are sent to a queue (without file lock), then written by one listener within main process
+    --> the worker processes send the records to the same queue.
+    """
+    global _log_queue, _log_listener
     logger = logging.getLogger()
-    logger_folder = 'log'
-    os.makedirs(logger_folder, exist_ok=True)
-    log_path = os.path.join(logger_folder,
-                            time.strftime(f'log_%Y%m%d%H%M%S', time.localtime(time.time())) + '.log')
-    logfile = os.path.abspath(log_path)
-    formatter = logging.Formatter('%(asctime)s|%(levelname)s|%(filename)s[%(lineno)d]|%(message)s')
-    rfh = ConcurrentRotatingFileHandler(logfile, 'a', 1024 * 1024, 5)
-    rfh.setFormatter(formatter)
-    logger.addHandler(rfh)
+    if _log_listener is None:
+        logger_folder = 'log'
+        os.makedirs(logger_folder, exist_ok=True)
+        log_path = os.path.join(logger_folder,
+                                time.strftime(f'log_%Y%m%d%H%M%S', time.localtime(time.time())) + '.log')
+        logfile = os.path.abspath(log_path)
+        formatter = logging.Formatter('%(asctime)s|%(levelname)s|%(filename)s[%(lineno)d]|%(message)s')
+        rfh = _LogHandler(logfile, 1024 * 1024, 5)
+        rfh.setFormatter(formatter)
+        _log_queue = multiprocessing.Queue()
+        _log_listener = _LogListener(_log_queue, rfh)
+        _log_listener.start()
+        # write the rest records when exits
+        atexit.register(_log_listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(_log_queue))
     if logger_level.lower() == 'info':
         logger.setLevel(logging.INFO)
     elif logger_level.lower() == 'warning':
@@ -67,6 +672,45 @@ def initialize_logger(logger_level='info'):
     return logger
 
 
+# the folder modified within this time (ns) of scanning is not trusted in the index (coarsest timestamp is 2s, FAT)
+_RACY_TIME = 2 * 10 ** 9
+
+# keep the path of set operation if it is: only in left, in both, only in right
+_MERGE_RULES = {
+    operator.or_: (True, True, True),
+    operator.and_: (False, True, False),
+    operator.sub: (True, False, False),
+    operator.xor: (True, False, True),
+}
+
+
+def _merge_sorted_paths(left, right, func):
+    """ set operation of two iterators of sorted and unique paths, by linear merging """
+    keep_left, keep_both, keep_right = _MERGE_RULES[func]
+    x = next(left, None)
+    y = next(right, None)
+    while x is not None and y is not None:
+        if x < y:
+            if keep_left:
+                yield x
+            x = next(left, None)
+        elif x > y:
+            if keep_right:
+                yield y
+            y = next(right, None)
+        else:
+            if keep_both:
+                yield x
+            x = next(left, None)
+            y = next(right, None)
+    if x is not None and keep_left:
+        yield x
+        yield from left
+    if y is not None and keep_right:
+        yield y
+        yield from right
+
+
 class FileProcessing(object):
     """
     recursively find file of processing
@@ -76,15 +720,56 @@ class FileProcessing(object):
         super().__init__()
         self.fp_input = self._set_parser_value(ops, 'input', None)
         self.fp_in_format = self._set_parser_value(ops, 'in_format', '\\')
+        self.fp_exclude = self._set_parser_value(ops, 'exclude', None)
+        self.fp_exclude_folder = self._set_parser_value(ops, 'exclude_folder', None)
         self.fp_output = self._set_parser_value(ops, 'output', None)
         self.fp_out_format = self._set_parser_value(ops, 'out_format', None)
         self.fp_cpu = self._set_parser_value(ops, 'cpu_number', 1)
         self.fp_multi_what = self._set_parser_value(ops, 'multi_what', 'mp')
+        self.fp_async_number = self._set_parser_value(ops, 'async_number', 100)
+        self.fp_thread_number = self._set_parser_value(ops, 'thread_number', 4)
+        self.fp_pipeline_thread_number = self._set_parser_value(ops, 'pipeline_thread_number', 4)
+        self.fp_batch_size = self._set_parser_value(ops, 'batch_size', 64)
+        self.fp_batch_bytes = self._set_parser_value(ops, 'batch_bytes', 0)
         self.fp_logger_level = self._set_parser_value(ops, 'logger_level', None)
+        self.fp_chunk_size = self._set_parser_value(ops, 'chunk_size', 0)
+        self.fp_schedule = self._set_parser_value(ops, 'schedule', None)
+        self.fp_max_pending = self._set_parser_value(ops, 'max_pending', 0)
+        self.fp_scan_thread_number = self._set_parser_value(ops, 'scan_thread_number', 8)
+        self.fp_incremental = self._set_parser_value(ops, 'incremental', False)
+        self.fp_resume = self._set_parser_value(ops, 'resume', False)
+        self.fp_journal = self._set_parser_value(ops, 'journal', None)
+        self.fp_timeout = self._set_parser_value(ops, 'timeout', None)
+        self.fp_retry_number = self._set_parser_value(ops, 'retry_number', 0)
+        self.fp_retry_delay = self._set_parser_value(ops, 'retry_delay', 1)
+        self.fp_failure_file = self._set_parser_value(ops, 'failure_file', None)
+        self.fp_failures = []
+        self.fp_metrics = self._set_parser_value(ops, 'metrics', None)
+        self.fp_profile = self._set_parser_value(ops, 'profile', None)
+        self.fp_index_cache = self._set_parser_value(ops, 'index_cache', None)
+        self.fp_dedup_cache = self._set_parser_value(ops, 'dedup_cache', None)
+        self.fp_dedup_cache_size = self._set_parser_value(ops, 'dedup_cache_size', 1 << 30)
+        self.fp_dedup_version = self._set_parser_value(ops, 'dedup_version', None)
+        self.fp_dedup_link = self._set_parser_value(ops, 'dedup_link', True)
+        self.fp_shard_index = self._set_parser_value(ops, 'shard_index', 0)
+        self.fp_shard_count = self._set_parser_value(ops, 'shard_count', 1)
+        self.fp_claim_folder = self._set_parser_value(ops, 'claim_folder', None)
+        self.fp_claim_timeout = self._set_parser_value(ops, 'claim_timeout', None)
+        self.fp_claim_run = self._set_parser_value(ops, 'claim_run', None)
+        self.fp_watch = self._set_parser_value(ops, 'watch', False)
+        self.fp_watch_interval = self._set_parser_value(ops, 'watch_interval', 1)
+        self.fp_watch_debounce = self._set_parser_value(ops, 'watch_debounce', 1)
+        self.fp_watch_duration = self._set_parser_value(ops, 'watch_duration', None)
+        self.fp_auto_interval = self._set_parser_value(ops, 'auto_interval', 2)
+        self.fp_auto_memory_reserve = self._set_parser_value(ops, 'auto_memory_reserve', 0.1)
         self.fp_paths = []
 
+        self._log_queue = None
         if self.fp_logger_level is not None:
             self.fp_logger = initialize_logger(self.fp_logger_level)
+            # for worker processes
+            self._log_queue = _log_queue
+            self._log_level = self.fp_logger.level
 
         # initialize parameter
         self._initialize_parameters()
@@ -97,16 +782,58 @@ class FileProcessing(object):
         # do once
         if self._do_once_status:
             args = self._do_once()
-            self._run_callback(args)
+            result = self._run_callback(args)
+            if isawaitable(result):
+                asyncio.run(result)
             return
 
-        if self._file_iterator_mode:
-            self._process_imp_imt()
+        if not self._async_mode and (iscoroutinefunction(self.do) or iscoroutinefunction(self.callback)):
+            raise ValueError('ERROR: coroutine `do` or `callback` requires async mode `async` or `iasync`!')
+        self._initialize_records()
+        start_time = time.perf_counter()
+        # the paths to process are filtered (and scheduled) for this run only
+        all_paths = self.fp_paths
+        try:
+            if not self._file_iterator_mode:
+                self.fp_paths = [x for x in self.fp_paths if self._in_shard(x) and self._need_process(x)]
+                if self.fp_schedule is not None and self.fp_paths:
+                    self._schedule_paths()
+            if not self._file_iterator_mode and not self.fp_paths:
+                print('<all files are up to date>')
+            elif self._async_mode:
+                asyncio.run(self._process_async())
+            elif self._file_iterator_mode:
+                self._process_imp_imt()
+            else:
+                self._process_mp_mt()
+        finally:
+            self.fp_paths = all_paths
+            self._path_costs = None
+            self._close_records()
+            self._merge_profiles()
+        self._report_metrics(time.perf_counter() - start_time)
+        if self._dedup_cache is not None:
+            self._dedup_cache.evict()
+        if self.fp_failures:
+            print(f'<{len(self.fp_failures)} files failed>')
         else:
-            self._process_mp_mt()
+            # keep the journal if failed, then only the failed files are processed when resuming
+            self._remove_journal()
 
         # clean output folder
         self._clean_output_folder()
+        if self.fp_failures and not self._isolate_failures:
+            self._raise_failure()
+
+    def _raise_serial_failure(self, result):
+        """ not isolated: the failure of single process is raised at once, the failures of workers at the end """
+        if result[1] is not None and not self._isolate_failures:
+            self._raise_failure()
+
+    def _raise_failure(self):
+        """ raise the first failure, if the failures are not isolated by `timeout`, `retry_number` or `failure_file` """
+        in_path, error = self.fp_failures[0]
+        raise RuntimeError(f'ERROR: processing failed: `{in_path}`\n{error}')
 
     def __len__(self):
         self._update_paths_len()
@@ -127,6 +854,13 @@ class FileProcessing(object):
     def __sub__(self, other_fp_obj):
         return self._set_operators(other_fp_obj, operator.sub)
 
+    def __getattr__(self, name):
+        """ the paths and input of set operations are evaluated when used """
+        if name in ('fp_paths', 'fp_input') and self.__dict__.get('_path_expression') is not None:
+            self._evaluate_paths()
+            return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
     def _initialize_parameters(self):
         # input controls
         assert self.fp_input is not None and self.fp_in_format is not None and len(self.fp_in_format) > 0
@@ -139,33 +873,256 @@ class FileProcessing(object):
         self._single_args_mode = self.fp_output is None
         if not self._single_args_mode and self.fp_out_format is None:
             self.fp_out_format = ''
+        # several patterns of `in_format`
+        if not isinstance(self.fp_in_format, str) and len(self.fp_in_format) == 1:
+            self.fp_in_format = self.fp_in_format[0]
+        self._is_multi_pattern = not isinstance(self.fp_in_format, str)
         # pattern identifier
         self._re_pattern_identifier = '\\'
-        self._is_re_pattern = self.fp_in_format.startswith(self._re_pattern_identifier)
         self._glob_pattern_identifier = '^'
-        self._is_glob_pattern = self.fp_in_format.startswith(self._glob_pattern_identifier)
         self._skip_pattern_identifier = '!'
-        self._is_skip_pattern = self.fp_in_format.startswith(self._skip_pattern_identifier)
-        # empty folder counter
-        self._empty_file_counter = 0
+        if self._is_multi_pattern:
+            if any(x.startswith(self._skip_pattern_identifier) for x in self.fp_in_format):
+                raise ValueError('ERROR: skip pattern `!` cannot be used with other patterns!')
+            self._is_re_pattern = self._is_glob_pattern = self._is_skip_pattern = False
+        else:
+            self._is_re_pattern = self.fp_in_format.startswith(self._re_pattern_identifier)
+            self._is_glob_pattern = self.fp_in_format.startswith(self._glob_pattern_identifier)
+            self._is_skip_pattern = self.fp_in_format.startswith(self._skip_pattern_identifier)
+        self._initialize_file_matcher()
+        # output folders: created by worker (once for each folder), and the number of produced files
+        self._out_folders = set()
+        self._out_folder_counts = {}
         self._total_file_number = 0
-        self._stop_each_file_cleaning_ratio = 0.1
         # callback number of inputs
         self._callback_input_length = len(signature(self.callback).parameters)
         self._callback_do_input_length = len(signature(self.do).parameters)
         # initialize other parameters
         self._do_once_status = False
+        # adaptive number of workers: tuned while processing, the other modes use all CPU
+        self._auto_mode = self.fp_cpu == 'auto'
+        if self._auto_mode:
+            self.fp_cpu = 0
+        self._auto_summary = None
         # file iterator mode, this mode do not separate search and process file, but do together
         self._file_iterator_mode = self.fp_multi_what[0] == 'i'
+        # async mode: `do` runs as coroutine (or within threads) on event loop
+        self._async_mode = self.fp_multi_what.endswith('async')
+        # pipeline mode: the stages `load` -> `process` -> `save` are rewritten rather than `do`
+        self._pipeline_mode = (type(self).process is not FileProcessing.process and
+                               type(self).do is FileProcessing.do)
+        if self._pipeline_mode and (self._async_mode or self.fp_timeout is not None):
+            raise ValueError('ERROR: pipeline cannot use async mode or `timeout`!')
+        # batch mode: `do_batch` is rewritten to process many files at once
+        self._batch_mode = type(self).do_batch is not FileProcessing.do_batch
+        if self._batch_mode and (self._async_mode or self.fp_timeout is not None or self._pipeline_mode):
+            raise ValueError('ERROR: `do_batch` cannot use async mode, `timeout` or pipeline!')
+        # schedule the files by cost
+        if self.fp_schedule is not None:
+            if self.fp_schedule not in ['size', 'interleave']:
+                raise ValueError('ERROR: `schedule` should be: `size` or `interleave`!')
+            if self._file_iterator_mode:
+                raise ValueError('ERROR: iterator mode cannot use `schedule`.')
+        self._path_costs = None
+        # incremental mode: skip files whose output is up to date
+        if self.fp_incremental is True:
+            self.fp_incremental = 'mtime'
+        if self.fp_incremental:
+            if self._single_args_mode:
+                raise ValueError('ERROR: incremental mode requires `output`!')
+            if self.fp_incremental not in ['mtime', 'manifest']:
+                raise ValueError('ERROR: `incremental` should be: `mtime` or `manifest`!')
+        self._manifest_name = '.fp_manifest'
+        self._manifest_record = None
+        self._manifest = {}
+        self._input_stats = {}
+        # resume mode: skip files recorded in journal by the interrupted run
+        self._journal_record = None
+        self._journal_done = set()
+        # states of started workers: {thread id: state}
+        self._worker_states = {}
+        # failed files: isolated (the processing goes on) if `timeout`, `retry_number` or `failure_file` is set
+        self._failure_record = None
+        self._isolate_failures = (self.fp_timeout is not None or self.fp_retry_number > 0 or
+                                  self.fp_failure_file is not None)
+        # timing and profiling of each file
+        self._measure_mode = self.fp_metrics is not None or self.fp_profile is not None
+        self._metrics_records = []
+        self._worker_profilers = []
+        self._profile_folder = None
+        # deduplication: reuse the output of identical input
+        self._dedup_cache = None
+        if self.fp_dedup_cache is not None:
+            if self._single_args_mode:
+                raise ValueError('ERROR: `dedup_cache` requires `output`!')
+            context = (f'{type(self).__module__}.{type(self).__qualname__}|{self.fp_dedup_version}|'
+                       f'{self.fp_out_format}')
+            self._dedup_cache = _DedupCache(os.path.abspath(self.fp_dedup_cache), self.fp_dedup_cache_size, context,
+                                            link=self.fp_dedup_link)
+        # sharding: the files are partitioned for several nodes by hash of path
+        if self.fp_shard_count < 1 or not 0 <= self.fp_shard_index < self.fp_shard_count:
+            raise ValueError('ERROR: `shard_index` should be in range of `shard_count`!')
+        # work-stealing: the nodes claim files within the shared folder, then process the others after its shard
+        if self.fp_claim_folder is not None and not self._file_iterator_mode:
+            raise ValueError('ERROR: `claim_folder` requires iterator mode!')
+        self._claim_owner = f'{socket.gethostname()}|{os.getpid()}'
+        # the claim files of claimed paths, to be finished
+        self._claim_paths = {}
+        # watch mode: process the new or modified files continuously
+        if self.fp_watch:
+            if self.fp_multi_what not in ['imp', 'imt']:
+                raise ValueError('ERROR: watch mode requires iterator mode `imp` or `imt`!')
+            if not os.path.isdir(self.fp_input):
+                raise ValueError('ERROR: watch mode requires input folder!')
+            if self._batch_mode or self.fp_claim_folder is not None:
+                raise ValueError('ERROR: watch mode cannot use `do_batch` or `claim_folder`!')
+
+    @staticmethod
+    def _get_patterns(patterns):
+        if patterns is None:
+            return []
+        return [patterns] if isinstance(patterns, str) else list(patterns)
+
+    def _initialize_file_matcher(self):
+        """ prepare the patterns of `in_format`, `exclude` and `exclude_folder` for file searching """
+        self._file_matcher = None
+        if not self._is_skip_pattern:
+            self._file_matcher = _PathMatcher(self._get_patterns(self.fp_in_format))
+        exclude = self._get_patterns(self.fp_exclude)
+        self._exclude_matcher = _PathMatcher(exclude) if exclude else None
+        # the folder is matched by glob (or regular expression) rather than extension
+        exclude_folder = [x if x.startswith((self._re_pattern_identifier, self._glob_pattern_identifier)) else
+                          self._glob_pattern_identifier + x for x in self._get_patterns(self.fp_exclude_folder)]
+        self._exclude_folder_matcher = _PathMatcher(exclude_folder) if exclude_folder else None
+
+    def _initialize_records(self):
+        """ initialize the record files before processing """
+        self.fp_failures = []
+        self._out_folders = set()
+        self._out_folder_counts = {}
+        self._metrics_records = []
+        if self.fp_profile is not None:
+            self._profile_folder = tempfile.mkdtemp(prefix='fp_profile_')
+        if self.fp_failure_file is not None:
+            self._failure_record = _PathRecord(os.path.abspath(self.fp_failure_file))
+        if self.fp_incremental == 'manifest':
+            self._manifest_record = _PathRecord(os.path.join(self.fp_output, self._manifest_name))
+            self._manifest = self._manifest_record.load()
+        if self.fp_resume:
+            self._journal_record = _PathRecord(self._get_journal_path())
+            self._journal_done = set(self._journal_record.load())
+
+    def _close_records(self):
+        if self._failure_record is not None:
+            self._failure_record.close()
+        if self._manifest_record is not None:
+            self._manifest_record.close()
+        if self._journal_record is not None:
+            self._journal_record.close()
+
+    def _remove_journal(self):
+        """ the journal is useless when all files are processed """
+        if self._journal_record is not None and os.path.isfile(self._journal_record.record_path):
+            os.remove(self._journal_record.record_path)
+
+    def _get_journal_path(self):
+        """ the journal is within output folder, or `./journal` folder if no output """
+        if self.fp_journal is not None:
+            return os.path.abspath(self.fp_journal)
+        if not self._single_args_mode:
+            return os.path.join(self.fp_output, '.fp_journal')
+        journal_name = hashlib.md5(f'{self.fp_input}|{self.fp_in_format}'.encode('utf-8')).hexdigest()
+        return os.path.abspath(os.path.join('journal', journal_name + '.journal'))
+
+    @property
+    def fp_worker_state(self):
+        """ the state of current worker (process or thread), initialized by `before_worker` """
+        state = getattr(_worker_local, 'state', None)
+        if state is None:
+            state = _worker_local.state = SimpleNamespace()
+        return state
+
+    def _connect_logger(self):
+        """ send the log records of worker process to the listener within main process """
+        if self._log_queue is None:
+            return
+        logger = logging.getLogger()
+        # the handlers inherited from main process (by `fork`) are replaced
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+        logger.addHandler(logging.handlers.QueueHandler(self._log_queue))
+        # the records below the level are rejected within worker
+        logger.setLevel(self._log_level)
+
+    def _start_worker(self):
+        """ initialize worker (process or thread) """
+        self.before_worker()
+        self._worker_states[threading.get_ident()] = self.fp_worker_state
+
+    def _stop_worker(self, barrier=None):
+        """ finalize the current worker thread within itself, after all threads are waiting if `barrier` """
+        if barrier is not None:
+            barrier.wait()
+        if self._worker_states.pop(threading.get_ident(), None) is not None:
+            self.after_worker()
+        _worker_local.state = None
+
+    def _stop_workers(self):
+        """ finalize the started workers (not finalized within its thread) """
+        for state in self._worker_states.values():
+            _worker_local.state = state
+            self.after_worker()
+        _worker_local.state = None
+        self._worker_states = {}
+        # save the profile of each worker
+        for profiler, worker_name in self._worker_profilers:
+            profiler.dump_stats(os.path.join(self._profile_folder, worker_name + '.prof'))
+        _worker_local.profiler = None
+        self._worker_profilers = []
+
+    @staticmethod
+    def _get_worker_name():
+        return f'{os.getpid()}-{threading.current_thread().name}'
+
+    def _get_worker_profiler(self):
+        """ the profiler of current worker process (only the first thread of process), `None` for other threads """
+        if self.fp_profile is None:
+            return None
+        profiler = getattr(_worker_local, 'profiler', None)
+        if profiler is None:
+            with _profiler_lock:
+                if self._worker_profilers:
+                    # the process is profiled by another thread
+                    return None
+                profiler = _worker_local.profiler = cProfile.Profile()
+                self._worker_profilers.append((profiler, self._get_worker_name()))
+        return profiler
+
+    def _merge_profiles(self):
+        """ merge the profiles of all workers into one file """
+        if self._profile_folder is None:
+            return
+        profile_paths = [os.path.join(self._profile_folder, x) for x in os.listdir(self._profile_folder)]
+        if profile_paths:
+            profile_path = os.path.abspath(self.fp_profile)
+            os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+            pstats.Stats(*profile_paths).dump_stats(profile_path)
+        shutil.rmtree(self._profile_folder, ignore_errors=True)
+        self._profile_folder = None
 
     def _initialize_paths(self):
+        self._path_list_file = None
+        self._path_list_root = None
         if os.path.isfile(self.fp_input):
             # if not meet input format requirement: consider it as paths text file
-            if not self._check_input_file_path(self.fp_input):
+            # --> the skip pattern `!` matches any file, then the input file is always paths text file
+            if self._is_skip_pattern or not self._check_input_file_path(self.fp_input):
+                self._path_list_file = self.fp_input
+                if self._file_iterator_mode:
+                    # if `multi_what` is iterator mode, read paths by stream when processing
+                    self.fp_input = self._get_path_list_root()
+                    return
                 self.fp_input, self.fp_paths = self._read_fs()
-                # fix parameters
-                self._file_iterator_mode = False
-                self.fp_multi_what = self.fp_multi_what.replace('i', '')
             # else: single process
             else:
                 self._do_once_status = True
@@ -181,17 +1138,47 @@ class FileProcessing(object):
         self._update_paths_len()
 
     def _set_operators(self, other_fp_obj, func):
-        if self._file_iterator_mode:
+        if self._file_iterator_mode or other_fp_obj._file_iterator_mode:
             raise ValueError('ERROR: iterator mode cannot use operator.')
-        new_obj = copy(self)
         self._check_format(other_fp_obj)
-        new_obj.fp_input, new_obj.fp_paths = self._tidy_fs(
-            list(
-                func(set(self.fp_paths), set(other_fp_obj.fp_paths))
-            )
-        )
+        # the paths of operands are captured now, only the merging is evaluated lazily
+        # --> then the chained operations are merged at once without intermediate lists
+        expression = (func, self._get_path_expression(), other_fp_obj._get_path_expression())
+        new_obj = copy(self)
+        new_obj.__dict__.pop('fp_input', None)
+        new_obj.__dict__.pop('fp_paths', None)
+        new_obj._path_expression = expression
         return new_obj
 
+    def _get_path_expression(self):
+        """
+        get the expression of paths for operations
+        :return: list of sorted and unique paths, or tuple (operator, left expression, right expression)
+        """
+        if self.__dict__.get('_path_expression') is not None:
+            return self._path_expression
+        paths = self.fp_paths
+        # the result of operations is already sorted, copied to be independent of the later changes
+        if all(x < y for x, y in zip(paths, itertools.islice(paths, 1, None))):
+            return list(paths)
+        return sorted(set(paths))
+
+    @staticmethod
+    def _iterate_sorted_paths(expression):
+        """ iterate the sorted and unique paths of expression, the operations are merged by stream """
+        if isinstance(expression, list):
+            return iter(expression)
+        func, left, right = expression
+        return _merge_sorted_paths(FileProcessing._iterate_sorted_paths(left),
+                                   FileProcessing._iterate_sorted_paths(right), func)
+
+    def _evaluate_paths(self):
+        """ the paths of operations are known to exist (or skipped), then only the common root is found """
+        paths = list(self._iterate_sorted_paths(self._path_expression))
+        self._path_expression = None
+        self.fp_paths = paths
+        self.fp_input = self._get_common_root(paths[0], paths[-1]) if paths else None
+
     def _update_paths_len(self):
         self._total_file_number = len(self.fp_paths)
         if not self._total_file_number:
@@ -225,6 +1212,120 @@ class FileProcessing(object):
         else:
             return 1
 
+    @staticmethod
+    def _chunk_paths(paths, chunk_size):
+        """ split paths into chunks """
+        for i in range(0, len(paths), chunk_size):
+            yield paths[i:i + chunk_size]
+
+    def _get_chunk_size(self, worker_number, max_chunk_size=256):
+        """
+        get the chunk size of tasks for each submit
+        :return: int; if `chunk_size` is not positive, choose it automatically
+        """
+        if self.fp_chunk_size > 0:
+            return self.fp_chunk_size
+        # 4 chunks for each worker, but small enough for the progress and balance at the end
+        chunk_size, extra = divmod(len(self.fp_paths), worker_number * 4)
+        if extra:
+            chunk_size += 1
+        # enough paths for the threads of worker
+        return max(min(chunk_size, max_chunk_size), self._get_thread_number())
+
+    def _get_thread_number(self):
+        """
+        get the number of threads within each worker process
+        :return: int; `thread_number` for hybrid modes `mpt` and `impt`, otherwise 1
+        """
+        if self.fp_multi_what not in ['mpt', 'impt']:
+            return 1
+        return max(self.fp_thread_number, 1)
+
+    def _get_process_executor(self, worker_number):
+        """
+        get the executor of worker processes, and the function to process a chunk of paths
+        :return: (ProcessPoolExecutor, function)
+        """
+        if self.fp_multi_what in ['mpt', 'impt']:
+            # hybrid mode: each process runs its threads
+            executor = ProcessPoolExecutor(max_workers=worker_number, initializer=_initialize_hybrid_worker,
+                                           initargs=(self._get_worker_obj(), self._get_thread_number()))
+            return executor, _do_multi_mapping_chunk_threaded
+        # send the object to workers once, then submit chunks of paths
+        executor = ProcessPoolExecutor(max_workers=worker_number, initializer=_initialize_worker,
+                                       initargs=(self._get_worker_obj(),))
+        return executor, _do_multi_mapping_chunk
+
+    def _get_chunks(self, worker_number):
+        """ split paths into chunks, by number of paths (and by cost if scheduled) """
+        chunk_size = self._get_chunk_size(worker_number)
+        if self._path_costs is None:
+            yield from self._chunk_paths(self.fp_paths, chunk_size)
+            return
+        # large files are sent alone, small files are sent together
+        max_chunk_cost = sum(self._path_costs) / (worker_number * 4)
+        chunk = []
+        chunk_cost = 0
+        for path, cost in zip(self.fp_paths, self._path_costs):
+            chunk.append(path)
+            chunk_cost += cost
+            if len(chunk) >= chunk_size or chunk_cost >= max_chunk_cost:
+                yield chunk
+                chunk = []
+                chunk_cost = 0
+        if chunk:
+            yield chunk
+
+    def _get_costs(self, paths):
+        costs = []
+        for path in paths:
+            try:
+                costs.append(self.cost(path))
+            except OSError:
+                costs.append(0)
+        return costs
+
+    def _schedule_paths(self):
+        """ order the paths by cost: largest first, or interleaved with the smallest """
+        with ThreadPoolExecutor(max_workers=max(self.fp_scan_thread_number, 1)) as executor:
+            costs = [x for chunk in executor.map(self._get_costs, self._chunk_paths(self.fp_paths, 1024))
+                     for x in chunk]
+        order = sorted(range(len(costs)), key=costs.__getitem__, reverse=True)
+        if self.fp_schedule == 'interleave':
+            order = [order[i // 2] if i % 2 == 0 else order[-(i // 2) - 1] for i in range(len(order))]
+        self.fp_paths = [self.fp_paths[i] for i in order]
+        self._path_costs = [costs[i] for i in order]
+
+    def _get_max_pending(self, worker_number):
+        """
+        get the maximum number of submitted but unfinished tasks for iterator mode
+        :return: int; if `max_pending` is not positive, choose it automatically
+        """
+        if self.fp_max_pending > 0:
+            return self.fp_max_pending
+        # 4 pending tasks for each worker
+        return worker_number * 4
+
+    def _get_worker_obj(self):
+        """ the copy of object for workers, without the paths and the records of main process """
+        worker_obj = copy(self)
+        worker_obj.fp_paths = []
+        worker_obj._manifest_record = None
+        worker_obj._manifest = {}
+        worker_obj._input_stats = {}
+        worker_obj._journal_record = None
+        worker_obj._journal_done = set()
+        worker_obj._worker_states = {}
+        worker_obj._path_costs = None
+        worker_obj._failure_record = None
+        worker_obj.fp_failures = []
+        worker_obj._metrics_records = []
+        worker_obj._worker_profilers = []
+        worker_obj._out_folders = set()
+        worker_obj._out_folder_counts = {}
+        worker_obj._claim_paths = {}
+        return worker_obj
+
     @staticmethod
     def _set_parser_value(ops, parser_name, default_value):
         """ set parser value to default if needed """
@@ -239,19 +1340,6 @@ class FileProcessing(object):
     def _glob_files(base_folder, pattern):
         return pathlib.Path(base_folder).glob(pattern)
 
-    @staticmethod
-    def _remove_empty_folder(target_folder):
-        """ if target folder is empty, then remove it """
-        for root, dirs, files in os.walk(target_folder, topdown=False):
-            for name in dirs:
-                dir_path = os.path.join(root, name)
-                if not os.listdir(str(dir_path)):
-                    path = os.path.join(root, name)
-                    shutil.rmtree(path)
-        # remove root
-        if os.path.isdir(target_folder) and not os.listdir(target_folder):
-            shutil.rmtree(target_folder)
-
     def _remove_empty_file(self, target_file_or_folder):
         """ if target file is empty, then remove it (or find within folder) """
 
@@ -266,33 +1354,296 @@ class FileProcessing(object):
             for f in fs:
                 rm_0_file(f)
 
-    @staticmethod
-    def _simplify_path(base, leaf):
-        """ remove empty folders recursively to base folder """
-        if not os.path.exists(leaf):
-            folder = leaf
+    def _make_out_folder(self, out_folder):
+        """ make the output folder once for each worker, the output folders are not removed during processing """
+        if out_folder not in self._out_folders:
+            os.makedirs(out_folder, exist_ok=True)
+            self._out_folders.add(out_folder)
 
-            while True:
-                folder = os.path.dirname(folder)
-                if len(folder) < len(base):
-                    break
-                # noinspection PyBroadException
+    def _get_out_folder(self, in_path):
+        """ get the output folder with the same file structure of input """
+        truncated_path = os.path.dirname(in_path)[len(self.fp_input) + 1:]
+        return os.path.join(self.fp_output, truncated_path)
+
+    def _get_out_name(self, in_path):
+        """ get the output file name with output format """
+        out_name = os.path.split(in_path)[1]
+        # truncated the format and add a new one
+        if self._is_re_pattern or self._is_glob_pattern or self._is_skip_pattern:
+            out_name = os.path.splitext(out_name)[0]
+        elif self._is_multi_pattern:
+            extension = self._file_matcher.match_extension(out_name)
+            if extension is None:
+                out_name = os.path.splitext(out_name)[0]
+            else:
+                out_name = out_name[:-len(extension) - 1]
+        else:
+            out_name = out_name[:-len(self.fp_in_format) - 1]
+        if self.fp_out_format != '':
+            out_name += '.'
+        out_name += self.fp_out_format
+        return out_name
+
+    def _is_up_to_date(self, in_path):
+        """ check the output of input file is up to date (incremental mode) """
+        out_path = os.path.join(self._get_out_folder(in_path), self._get_out_name(in_path))
+        try:
+            in_stat = os.stat(in_path)
+        except OSError:
+            return False
+        try:
+            out_stat = os.stat(out_path)
+        except OSError:
+            out_stat = None
+        if self.fp_incremental == 'mtime':
+            return out_stat is not None and out_stat.st_mtime_ns >= in_stat.st_mtime_ns
+        # manifest: compare with the input status when it was processed
+        fields = [str(in_stat.st_mtime_ns), str(in_stat.st_size)]
+        if out_stat is not None and self._manifest.get(in_path) == fields:
+            return True
+        self._input_stats[in_path] = fields
+        return False
+
+    def _need_process(self, in_path):
+        """ check the input file should be dispatched to process """
+        if self._journal_done and in_path in self._journal_done:
+            return False
+        if self.fp_incremental and self._is_up_to_date(in_path):
+            return False
+        return True
+
+    def _get_relative_path(self, in_path):
+        """ the path relative to input folder, to be same for all nodes """
+        return in_path[len(self.fp_input) + 1:]
+
+    def _in_shard(self, in_path):
+        """ check the file belongs to the shard of this node """
+        if self.fp_shard_count <= 1:
+            return True
+        path_hash = zlib.crc32(self._get_relative_path(in_path).encode('utf-8', 'surrogateescape'))
+        return path_hash % self.fp_shard_count == self.fp_shard_index
+
+    def _get_claim_path(self, in_path):
+        """
+        the claim file of the version (modified time and size) of file within the run
+        :return: str; `None` if the file is not found
+        """
+        try:
+            stat = os.stat(in_path)
+        except OSError:
+            return None
+        key = f'{self._get_relative_path(in_path)}|{stat.st_mtime_ns}|{stat.st_size}'
+        claim_name = hashlib.md5(key.encode('utf-8', 'surrogateescape')).hexdigest()
+        run_folder = self.fp_claim_folder if self.fp_claim_run is None else os.path.join(self.fp_claim_folder,
+                                                                                          str(self.fp_claim_run))
+        return os.path.join(run_folder, claim_name[:2], claim_name)
+
+    def _release_stale_claim(self, claim_path):
+        """
+        release the claim if the node has not finished it within `claim_timeout` (such as the node crashed)
+        :return: bool; the claim is released
+        """
+        if self.fp_claim_timeout is None:
+            return False
+        try:
+            if time.time() - os.path.getmtime(claim_path) <= self.fp_claim_timeout:
+                return False
+            with open(claim_path, 'r') as f:
+                if f.read() == 'done':
+                    return False
+            # only one node can move the stale claim
+            stale_path = f'{claim_path}.{os.getpid()}.stale'
+            os.rename(claim_path, stale_path)
+            os.remove(stale_path)
+        except OSError:
+            return False
+        return True
+
+    def _claim_path(self, in_path):
+        """ claim the file by creating claim file exclusively, so that only one node processes it """
+        claim_path = self._get_claim_path(in_path)
+        if claim_path is None:
+            return False
+        os.makedirs(os.path.dirname(claim_path), exist_ok=True)
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._release_stale_claim(claim_path):
+                return False
+            try:
+                fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._claim_owner)
+        self._claim_paths[in_path] = claim_path
+        return True
+
+    def _finish_claim(self, in_path):
+        """ mark the claimed file as finished (done or failed), it will not be released as stale """
+        claim_path = self._claim_paths.pop(in_path, None)
+        if claim_path is not None:
+            with open(claim_path, 'w') as f:
+                f.write('done')
+
+    def _iterate_paths(self):
+        """
+        the paths to process for iterator mode (with shard)
+        --> work-stealing: claim the files of its shard first, then the leftover files of other shards
+        """
+        if self.fp_watch:
+            return self._watch_fs()
+        if self.fp_claim_folder is None:
+            return filter(self._need_process, filter(self._in_shard, self._find_fs_iterator()))
+        paths = filter(self._in_shard, self._find_fs_iterator())
+        if self.fp_shard_count > 1:
+            other_paths = filter(lambda x: not self._in_shard(x), self._find_fs_iterator())
+            paths = itertools.chain(paths, other_paths)
+        return filter(self._claim_path, filter(self._need_process, paths))
+
+    def _poll_changes(self, index, snapshot):
+        """
+        poll the input folder: list the modified folders only, and compare the modified time and size of files
+        :return: list; new or modified paths
+        """
+        new_index = {}
+        new_snapshot = {}
+        changed = []
+        folders = [self.fp_input]
+        while folders:
+            matched, sub_folders = self._scan_folder(folders.pop(), index, new_index)
+            folders.extend(sub_folders)
+            for path in matched:
                 try:
-                    if os.path.exists(folder) and not os.listdir(folder):
-                        shutil.rmtree(folder)
-                    else:
-                        break
-                except Exception:
-                    break
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                new_snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+                if snapshot.get(path) != new_snapshot[path]:
+                    changed.append(path)
+        index.clear()
+        index.update(new_index)
+        snapshot.clear()
+        snapshot.update(new_snapshot)
+        return changed
+
+    def _add_watch(self, inotify, flags, watched, folder):
+        """
+        watch the folder and its sub-folders by `inotify`
+        :return: list; matched paths already in the folders
+        """
+        mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+        matched_paths = []
+        folders = [folder]
+        while folders:
+            folder = folders.pop()
+            try:
+                watched[inotify.add_watch(folder, mask)] = folder
+            except OSError:
+                continue
+            # list after watching, then the files created meanwhile are not missed
+            matched, sub_folders = self._list_folder(folder)
+            matched_paths.extend(matched)
+            folders.extend(sub_folders)
+        return matched_paths
+
+    def _read_changes(self, inotify, flags, watched):
+        """
+        read the events of `inotify` within `watch_interval`
+        :return: list; new or modified paths
+        """
+        changed = []
+        for event in inotify.read(timeout=int(self.fp_watch_interval * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                print('<too many file events, some changes are missed>')
+                continue
+            if event.mask & flags.IGNORED:
+                # the folder is removed
+                watched.pop(event.wd, None)
+                continue
+            folder = watched.get(event.wd)
+            if folder is None or not event.name:
+                continue
+            path = os.path.join(folder, event.name)
+            if event.mask & flags.ISDIR:
+                if not self._is_excluded_folder(path, event.name):
+                    changed.extend(self._add_watch(inotify, flags, watched, path))
+            elif self._match_file(path, event.name):
+                changed.append(path)
+        return changed
+
+    def _watch_fs(self):
+        """
+        watch mode: the existing files first, then the new or modified files continuously
+        --> by `inotify` if available, otherwise by polling the modified folders and files;
+        --> the changed file is dispatched if not changed again within `watch_debounce` seconds.
+        """
+        try:
+            import inotify_simple
+        except ImportError:
+            inotify_simple = None
+        end_time = None if self.fp_watch_duration is None else time.time() + self.fp_watch_duration
+        if inotify_simple is not None:
+            inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            watched = {}
+            paths = self._add_watch(inotify, flags, watched, self.fp_input)
+        else:
+            inotify = None
+            index = {}
+            snapshot = {}
+            paths = self._poll_changes(index, snapshot)
+        # changes: {path: ((modified time, size), time of last change)}
+        changes = {}
+        try:
+            yield from filter(self._need_process, filter(self._in_shard, paths))
+            while end_time is None or time.time() < end_time:
+                if inotify is not None:
+                    paths = self._read_changes(inotify, flags, watched)
+                else:
+                    time.sleep(self.fp_watch_interval)
+                    paths = self._poll_changes(index, snapshot)
+                now = time.time()
+                for path in filter(self._in_shard, paths):
+                    changes[path] = (None, now)
+                # debounce: the files being written are changing
+                for path, (stat_key, change_time) in list(changes.items()):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        del changes[path]
+                        continue
+                    if (stat.st_mtime_ns, stat.st_size) != stat_key:
+                        changes[path] = ((stat.st_mtime_ns, stat.st_size), now)
+                    elif now - change_time >= self.fp_watch_debounce:
+                        del changes[path]
+                        yield path
+        except KeyboardInterrupt:
+            print('<watch mode stopped>')
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _record_done(self, args):
+        """ record the done files during callback """
+        self._finish_claim(args if self._single_args_mode else args[0])
+        if self._journal_record is not None:
+            self._journal_record.add(args if self._single_args_mode else args[0])
+        if self._manifest_record is not None:
+            in_path = args[0]
+            fields = self._input_stats.pop(in_path, None)
+            if fields is not None:
+                self._manifest_record.add(in_path, *fields)
 
     def _do_multi_mapping(self, in_path):
         """ prepare function for multiple mapping """
         if not self._single_args_mode:
             # prepare output path
-            truncated_path = os.path.dirname(in_path)[len(self.fp_input) + 1:]
-            out_folder = os.path.join(self.fp_output, truncated_path)
+            out_folder = self._get_out_folder(in_path)
             # make directories
-            os.makedirs(out_folder, exist_ok=True)
+            self._make_out_folder(out_folder)
+            if self._dedup_cache is not None:
+                return self._do_single_dedup(in_path, out_folder)
             # do operation
             out_path = self._do_single(in_path, out_folder)
             return in_path, out_path
@@ -300,22 +1651,244 @@ class FileProcessing(object):
             self._do_single(in_path)
             return in_path
 
+    def _format_error(self, e):
+        if not self._isolate_failures:
+            # the failure will be raised, keep the traceback
+            return ''.join(traceback.format_exception(type(e), e, e.__traceback__)).rstrip()
+        error = f'{type(e).__name__}: {e}' if str(e) else type(e).__name__
+        # keep the error in one line for the record
+        return ' '.join(error.split())
+
+    def _get_retry_delay(self, attempt):
+        """ exponential backoff of retries """
+        return self.fp_retry_delay * 2 ** attempt
+
+    def _do_multi_mapping_measured(self, in_path, submit_time=None):
+        """
+        process the file, with timing and profiling if required
+        :return: (object, tuple); arguments of callback, metrics (worker, wall time, cpu time, queue wait time)
+        """
+        if not self._measure_mode:
+            return self._do_multi_mapping(in_path), None
+        profiler = self._get_worker_profiler()
+        start_time = time.time()
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.thread_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            args = self._do_multi_mapping(in_path)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        metrics = (self._get_worker_name(), time.perf_counter() - start_wall_time, time.thread_time() - start_cpu_time,
+                   0 if submit_time is None else max(start_time - submit_time, 0))
+        return args, metrics
+
+    def _do_task(self, in_path, retry=True, submit_time=None):
+        """
+        process the file (and retry if failed), the failure is returned rather than raised
+        :return: (object, str, tuple); (arguments of callback, None, metrics) or (input path, error message, None)
+        """
+        attempt = 0
+        while True:
+            try:
+                args, metrics = self._do_multi_mapping_measured(in_path, submit_time)
+                return args, None, metrics
+            except Exception as e:
+                if getattr(self, 'fp_logger', None) is not None:
+                    self.fp_logger.exception(f'processing failed: `{in_path}`')
+                if not retry or attempt >= self.fp_retry_number:
+                    return in_path, self._format_error(e), None
+                time.sleep(self._get_retry_delay(attempt))
+                attempt += 1
+
+    async def _do_task_async(self, in_path, executor):
+        """ process the file on event loop (with timeout and retries) """
+        submit_time = time.time()
+        attempt = 0
+        while True:
+            try:
+                if executor is None:
+                    start_time = time.time()
+                    start_wall_time = time.perf_counter()
+                    args = await asyncio.wait_for(self._do_multi_mapping_async(in_path), self.fp_timeout)
+                    # the cpu time of coroutine is unknown
+                    metrics = (self._get_worker_name(), time.perf_counter() - start_wall_time, None,
+                               start_time - submit_time)
+                else:
+                    args, metrics = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(
+                        executor, self._do_multi_mapping_measured, in_path, submit_time), self.fp_timeout)
+                return args, None, metrics
+            except asyncio.TimeoutError:
+                error = f'TimeoutError: {self.fp_timeout} seconds'
+            except Exception as e:
+                if getattr(self, 'fp_logger', None) is not None:
+                    self.fp_logger.exception(f'processing failed: `{in_path}`')
+                error = self._format_error(e)
+            if attempt >= self.fp_retry_number:
+                return in_path, error, None
+            await asyncio.sleep(self._get_retry_delay(attempt))
+            attempt += 1
+
+    def _do_multi_mapping_batch(self, in_paths):
+        """
+        prepare function for a batch of files
+        :return: list; arguments of callback for each file
+        """
+        if not self._single_args_mode:
+            out_folders = [self._get_out_folder(x) for x in in_paths]
+            # make directories once for the batch
+            for out_folder in set(out_folders):
+                self._make_out_folder(out_folder)
+            out_paths = [os.path.join(y, self._get_out_name(x)) for x, y in zip(in_paths, out_folders)]
+            self.do_batch(in_paths, out_paths)
+            return list(zip(in_paths, out_paths))
+        else:
+            self.do_batch(in_paths)
+            return list(in_paths)
+
+    def _do_batch_task(self, in_paths, submit_time=None):
+        """
+        process a batch of files (and retry if failed), the failure is returned rather than raised
+        :return: list; (arguments of callback, None, metrics) or (input path, error message, None) for each file
+        """
+        attempt = 0
+        while True:
+            profiler = self._get_worker_profiler()
+            start_time = time.time()
+            start_wall_time = time.perf_counter()
+            start_cpu_time = time.thread_time()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                results = self._do_multi_mapping_batch(in_paths)
+            except Exception as e:
+                if getattr(self, 'fp_logger', None) is not None:
+                    self.fp_logger.exception(f'processing failed: batch of `{in_paths[0]}`...')
+                if attempt >= self.fp_retry_number:
+                    error = self._format_error(e)
+                    return [(x, error, None) for x in in_paths]
+                time.sleep(self._get_retry_delay(attempt))
+                attempt += 1
+                continue
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            if not self._measure_mode:
+                return [(x, None, None) for x in results]
+            # the time of batch is shared by its files
+            metrics = (self._get_worker_name(), (time.perf_counter() - start_wall_time) / len(in_paths),
+                       (time.thread_time() - start_cpu_time) / len(in_paths),
+                       0 if submit_time is None else max(start_time - submit_time, 0))
+            return [(x, None, metrics) for x in results]
+
+    def _get_batches(self, paths, batch_size):
+        """ group paths into batches by number of files (`batch_size`) and total size (`batch_bytes`) """
+        batch = []
+        batch_bytes = 0
+        for path in paths:
+            size = 0
+            if self.fp_batch_bytes > 0:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    pass
+            if batch and (len(batch) >= batch_size > 0 or batch_bytes + size > self.fp_batch_bytes > 0):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(path)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _record_metrics(self, args, metrics):
+        """ record the timing of done files during callback """
+        if self.fp_metrics is not None and metrics is not None:
+            self._metrics_records.append((args if self._single_args_mode else args[0],) + metrics)
+
+    @staticmethod
+    def _get_statistics(values):
+        """ percentiles of values """
+        values = sorted(x for x in values if x is not None)
+        if not values:
+            return None
+        statistics = {f'p{x}': values[min(int(len(values) * x / 100), len(values) - 1)] for x in [50, 90, 99]}
+        statistics.update({'max': values[-1], 'mean': sum(values) / len(values), 'total': sum(values)})
+        return statistics
+
+    def _report_metrics(self, elapsed_time):
+        """
+        save the metrics of processing:
+        --> summary (json): percentiles, the slowest files, and the overhead of framework;
+        --> each file (csv): worker, wall time, cpu time, queue wait time.
+        """
+        if self.fp_metrics is None:
+            return
+        records = self._metrics_records
+        workers = {}
+        for record in records:
+            workers[record[1]] = workers.get(record[1], 0) + 1
+        busy_time = sum(x[2] for x in records)
+        # overhead: the time of workers not used by `do`
+        overhead = 1 - self._safe_division(busy_time, elapsed_time * max(len(workers), 1))
+        summary = {
+            'file_number': len(records),
+            'failed_number': len(self.fp_failures),
+            'elapsed_time': elapsed_time,
+            'files_per_second': len(records) / elapsed_time if elapsed_time > 0 else 0,
+            'worker_number': len(workers),
+            'overhead_fraction': min(max(overhead, 0), 1),
+            'wall_time': self._get_statistics(x[2] for x in records),
+            'cpu_time': self._get_statistics(x[3] for x in records),
+            'queue_wait_time': self._get_statistics(x[4] for x in records),
+            'slowest_files': [{'path': x[0], 'worker': x[1], 'wall_time': x[2], 'cpu_time': x[3],
+                               'queue_wait_time': x[4]} for x in sorted(records, key=lambda x: -x[2])[:10]],
+            'workers': workers,
+        }
+        if self._auto_summary is not None:
+            summary['auto'] = self._auto_summary
+        metrics_path = os.path.abspath(self.fp_metrics)
+        os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+        with open(metrics_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(os.path.splitext(metrics_path)[0] + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['path', 'worker', 'wall_time', 'cpu_time', 'queue_wait_time'])
+            writer.writerows(records)
+
+    def _record_failure(self, in_path, error):
+        """ record the failed files during callback """
+        self._finish_claim(in_path)
+        self.fp_failures.append((in_path, error))
+        if not self._single_args_mode:
+            # the output folder may be created
+            out_path = os.path.join(self._get_out_folder(in_path), self._get_out_name(in_path))
+            self._out_folder_counts.setdefault(os.path.dirname(out_path), 0)
+        self._input_stats.pop(in_path, None)
+        if self._failure_record is not None:
+            self._failure_record.add(in_path, error)
+
+    async def _do_multi_mapping_async(self, in_path):
+        """ prepare coroutine for multiple mapping, if `do` is coroutine """
+        if not self._single_args_mode:
+            out_folder = self._get_out_folder(in_path)
+            self._make_out_folder(out_folder)
+            out_path = os.path.join(out_folder, self._get_out_name(in_path))
+            await self.do(in_path, out_path)
+            return in_path, out_path
+        else:
+            await self.do(in_path)
+            return in_path
+
     def _do_single(self, *args):
         """ single process """
         # in_path: str; input file path
         # out_folder: str; output folder
         if not self._single_args_mode:
             in_path, out_folder = args
-            out_name = os.path.split(in_path)[1]
-            # truncated the format and add a new one
-            if self._is_re_pattern or self._is_glob_pattern or self._is_skip_pattern:
-                out_name = os.path.splitext(out_name)[0]
-            else:
-                out_name = out_name[:-len(self.fp_in_format) - 1]
-            if self.fp_out_format != '':
-                out_name += '.'
-            out_name += self.fp_out_format
-            out_path = os.path.join(out_folder, out_name)
+            out_path = os.path.join(out_folder, self._get_out_name(in_path))
             # the 'do' function is main function for batch process
             self.do(in_path, out_path)
             return out_path
@@ -325,66 +1898,207 @@ class FileProcessing(object):
             self.do(path)
             return path
 
-    def _find_fs(self):
-        """ find files from glob function """
-        # find all patterns from regular expression
-        if self._is_re_pattern:
-            # if contains `pattern_identifier`, it is considered to be regular expression restrictions
-            pattern = self.fp_in_format[len(self._re_pattern_identifier):]
-            fs = self._glob_files(self.fp_input, '**/*')
-            fs = [str(x) for x in fs if os.path.isfile(x) and re.search(pattern, os.path.split(x)[-1]) is not None]
-        elif self._is_glob_pattern:
-            pattern = self.fp_in_format[len(self._glob_pattern_identifier):]
-            fs = self._glob_files(self.fp_input, '**/' + pattern)
-            fs = [str(x) for x in fs if os.path.isfile(x)]
-        elif self._is_skip_pattern:
-            fs = self._glob_files(self.fp_input, '**/*')
-            fs = [str(x) for x in fs]
+    def _do_single_dedup(self, in_path, out_folder):
+        """ process the file, or reuse the cached output of identical input """
+        out_path = os.path.join(out_folder, self._get_out_name(in_path))
+        key = self._dedup_cache.get_key(in_path)
+        if self._dedup_cache.restore(key, out_path):
+            return in_path, out_path
+        self._dedup_cache.prepare(out_path)
+        out_path = self._do_single(in_path, out_folder)
+        self._dedup_cache.store(key, out_path)
+        return in_path, out_path
+
+    def _save_output(self, in_path, data):
+        """
+        the stage `save` of pipeline
+        :return: object; arguments of callback
+        """
+        if not self._single_args_mode:
+            out_folder = self._get_out_folder(in_path)
+            self._make_out_folder(out_folder)
+            out_path = os.path.join(out_folder, self._get_out_name(in_path))
+            self.save(data, out_path)
+            return in_path, out_path
         else:
-            fs = self._glob_files(self.fp_input, '**/*.' + self.fp_in_format)
-            fs = [str(x) for x in fs if os.path.isfile(x)]
-        return fs
+            self.save(data, in_path)
+            return in_path
 
-    def _find_fs_iterator(self):
-        if self._is_re_pattern:
-            pattern = self.fp_in_format[len(self._re_pattern_identifier):]
-            for x in glob.iglob(os.path.join(f'{self.fp_input}', '**/*'), recursive=True):
-                if os.path.isfile(x) and re.search(pattern, os.path.split(x)[-1]) is not None:
-                    yield x
-        elif self._is_glob_pattern:
-            pattern = self.fp_in_format[len(self._glob_pattern_identifier):]
-            for x in glob.iglob(os.path.join(f'{self.fp_input}', '**/' + pattern), recursive=True):
-                if os.path.isfile(x):
-                    yield x
-        elif self._is_skip_pattern:
-            for x in glob.iglob(os.path.join(f'{self.fp_input}', '**/*'), recursive=True):
-                yield x
+    def _do_stage(self, stage, *args):
+        """
+        run a stage of pipeline (and retry if failed)
+        :return: (object, str, float); result of stage, worker, seconds
+        """
+        attempt = 0
+        while True:
+            profiler = self._get_worker_profiler()
+            start_wall_time = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = getattr(self, stage)(*args)
+                return result, self._get_worker_name(), time.perf_counter() - start_wall_time
+            except Exception:
+                if getattr(self, 'fp_logger', None) is not None:
+                    self.fp_logger.exception(f'stage `{stage}` failed')
+                if attempt >= self.fp_retry_number:
+                    raise
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            time.sleep(self._get_retry_delay(attempt))
+            attempt += 1
+
+    def _match_file(self, path, name):
+        """ check the file name (or last parts of path) that match the input format, and not excluded """
+        if self._file_matcher is not None and not self._file_matcher.match(path, name):
+            return False
+        return self._exclude_matcher is None or not self._exclude_matcher.match(path, name)
+
+    def _is_excluded_folder(self, path, name):
+        return self._exclude_folder_matcher is not None and self._exclude_folder_matcher.match(path, name)
+
+    def _in_excluded_folder(self, in_path, root):
+        """ check any folder of the path (within root folder) is excluded """
+        if self._exclude_folder_matcher is None:
+            return False
+        folder = os.path.dirname(in_path)
+        while len(folder) > len(root):
+            if self._is_excluded_folder(folder, os.path.basename(folder)):
+                return True
+            folder = os.path.dirname(folder)
+        return False
+
+    def _list_folder(self, folder):
+        """
+        list the folder once by `os.scandir`, with the cached file type of entries
+        :return: (list, list); matched paths, sub-folders to search
+        """
+        matched = []
+        sub_folders = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    # do not follow the symbolic link of folders, which may cause loops
+                    is_folder = entry.is_dir(follow_symlinks=False)
+                    if is_folder:
+                        # prune the excluded folder before searching into it
+                        if self._is_excluded_folder(entry.path, entry.name):
+                            continue
+                        sub_folders.append(entry.path)
+                    if self._is_skip_pattern:
+                        matched.append(entry.path)
+                    elif not is_folder and self._match_file(entry.path, entry.name) and entry.is_file():
+                        matched.append(entry.path)
+        except OSError:
+            # the folder cannot be read (permission or removed)
+            pass
+        return matched, sub_folders
+
+    def _scan_folder(self, folder, index, new_index):
+        """
+        list the folder, or get it from the index if the folder is not modified
+        :return: (list, list); matched paths, sub-folders to search
+        """
+        if index is None:
+            return self._list_folder(folder)
+        scan_time = time.time_ns()
+        try:
+            modified_time = os.stat(folder).st_mtime_ns
+        except OSError:
+            return [], []
+        cached = index.get(folder)
+        if cached is not None and cached[0] == modified_time:
+            matched, sub_folders = cached[1], cached[2]
         else:
-            for x in glob.iglob(os.path.join(f'{self.fp_input}', '**/*.' + self.fp_in_format), recursive=True):
-                if os.path.isfile(x):
-                    yield x
+            matched, sub_folders = self._list_folder(folder)
+        # racy folder: it may be modified again within the same timestamp after listing, so always list it
+        if scan_time - modified_time >= _RACY_TIME:
+            new_index[folder] = (modified_time, matched, sub_folders)
+        return matched, sub_folders
 
-    @staticmethod
-    def _get_common_path(path_a, path_b):
-        """ get common path from two given paths """
-        i = 0
-        while i < min(len(path_a), len(path_b)):
-            if path_a[i] == path_b[i]:
-                i += 1
-            else:
-                break
-        return path_a[:i]
+    def _get_index_cache_path(self):
+        """ the index file for each input folder and input format """
+        index_name = f'{self.fp_input}|{self.fp_in_format}'
+        if self._exclude_matcher is not None or self._exclude_folder_matcher is not None:
+            # the searched files also depend on the excluded patterns
+            index_name += f'|{self.fp_exclude}|{self.fp_exclude_folder}'
+        index_name = hashlib.md5(index_name.encode('utf-8')).hexdigest()
+        return os.path.join(os.path.abspath(self.fp_index_cache), index_name + '.index')
+
+    def _load_index_cache(self):
+        """
+        load the index of folders from the last search
+        :return: dict; {folder: (modified time, matched paths, sub-folders)}, `None` if not used
+        """
+        if self.fp_index_cache is None:
+            return None
+        index_path = self._get_index_cache_path()
+        if not os.path.isfile(index_path):
+            return {}
+        # noinspection PyBroadException
+        try:
+            with open(index_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # broken index: search again
+            return {}
+
+    def _save_index_cache(self, index):
+        index_path = self._get_index_cache_path()
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        temp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, index_path)
+
+    def _walk_fs(self):
+        """ walk the input folder by `os.scandir`, the sub-folders are listed concurrently """
+        index = self._load_index_cache()
+        # only keep the existing folders in new index
+        new_index = {}
+        if self.fp_scan_thread_number <= 1:
+            folders = [self.fp_input]
+            while folders:
+                matched, sub_folders = self._scan_folder(folders.pop(), index, new_index)
+                folders.extend(reversed(sub_folders))
+                yield from matched
+        else:
+            # the folders to scan (depth first), at most 2 scans for each thread are in flight
+            # --> the scanning only goes on as the paths are consumed, then the memory stays flat
+            folders = [self.fp_input]
+            max_scanning = self.fp_scan_thread_number * 2
+            with ThreadPoolExecutor(max_workers=self.fp_scan_thread_number) as executor:
+                pending = set()
+                while folders or pending:
+                    while folders and len(pending) < max_scanning:
+                        pending.add(executor.submit(self._scan_folder, folders.pop(), index, new_index))
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        matched, sub_folders = future.result()
+                        folders.extend(reversed(sub_folders))
+                        yield from matched
+        if index is not None:
+            self._save_index_cache(new_index)
+
+    def _find_fs(self):
+        """ find files by walking the input folder """
+        return list(self._walk_fs())
+
+    def _find_fs_iterator(self):
+        if self._path_list_file is not None:
+            # check the paths lazily
+            for path in self._iterate_path_list(self._path_list_file):
+                if self._in_excluded_folder(path, self._path_list_root):
+                    continue
+                if self._is_skip_pattern or self._check_input_file_path(path):
+                    yield path
+        else:
+            yield from self._walk_fs()
 
     def _check_input_file_path(self, in_path):
         """ check file that match the input format, and its existence """
-        if self._is_re_pattern:
-            pattern = self.fp_in_format[len(self._re_pattern_identifier):]
-            condition = re.search(pattern, os.path.split(in_path)[-1]) is not None
-            condition = condition and os.path.exists(in_path)
-        else:
-            condition = in_path.endswith('.' + self.fp_in_format)
-            condition = condition and os.path.exists(in_path)
-        return condition
+        return self._match_file(in_path, os.path.basename(in_path)) and os.path.exists(in_path)
 
     @staticmethod
     def _safe_division(x, y):
@@ -394,34 +2108,117 @@ class FileProcessing(object):
             return x / y
 
     def _clean_output_folder(self):
-        if not self._single_args_mode and (
-                self._safe_division(self._empty_file_counter,
-                                    self._total_file_number) > self._stop_each_file_cleaning_ratio):
-            self._remove_empty_folder(self.fp_output)
+        """ remove the empty output folders by the number of produced files, without walking the output folder """
+        if self._single_args_mode:
+            return
+        # the sub-folders first
+        empty_folders = sorted((x for x, y in self._out_folder_counts.items() if y == 0), key=len, reverse=True)
+        for folder in empty_folders:
+            while len(folder) >= len(self.fp_output) and not self._out_folder_counts.get(folder, 0):
+                try:
+                    # only the empty folder can be removed
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+
+    @staticmethod
+    def _get_common_root(min_path, max_path):
+        """ the common root of sorted paths is the common root of the first and last one """
+        return os.path.dirname(os.path.commonprefix([min_path, max_path]))
+
+    def _filter_input_paths(self, paths):
+        return [x for x in paths if self._check_input_file_path(x)]
 
     def _tidy_fs(self, lines):
-        """ check file status and find common root path """
-        fs = []
-        if len(lines) == 0:
+        """ check file status (concurrently) and find common root path """
+        if self._is_skip_pattern:
+            fs = list(lines)
+        else:
+            with ThreadPoolExecutor(max_workers=max(self.fp_scan_thread_number, 1)) as executor:
+                fs = [x for chunk in executor.map(self._filter_input_paths, self._chunk_paths(lines, 1024))
+                      for x in chunk]
+        if len(fs) == 0:
             return None, fs
-        common_path = lines[0]
-        for line in lines:
-            path = line.strip()
-            if self._is_skip_pattern or self._check_input_file_path(path):
-                fs.append(path)
-                common_path = self._get_common_path(path, common_path)
-        # tidy path
-        common_path = os.path.dirname(common_path)
+        common_path = self._get_common_root(min(fs), max(fs))
+        if self._exclude_folder_matcher is not None:
+            # the folders are excluded within the common root
+            fs = [x for x in fs if not self._in_excluded_folder(x, common_path)]
+            if len(fs) == 0:
+                return None, fs
+            common_path = self._get_common_root(min(fs), max(fs))
         return common_path, fs
 
+    @staticmethod
+    def _iterate_path_list(list_path, buffer_size=1 << 20):
+        """
+        read paths from text file by stream: one line with one path, or separated by NUL character
+        --> gzip compressed text file is also supported.
+        """
+        with open(list_path, 'rb') as f:
+            is_gzip = f.read(2) == b'\x1f\x8b'
+        with (gzip.open if is_gzip else open)(list_path, 'rb') as f:
+            separator = None
+            remainder = b''
+            while True:
+                block = f.read(buffer_size)
+                if not block:
+                    break
+                if separator is None:
+                    separator = b'\0' if b'\0' in block else b'\n'
+                parts = (remainder + block).split(separator)
+                remainder = parts.pop()
+                for part in parts:
+                    path = os.fsdecode(part) if separator == b'\0' else os.fsdecode(part).strip()
+                    if path:
+                        yield path
+            path = os.fsdecode(remainder) if separator == b'\0' else os.fsdecode(remainder).strip()
+            if path:
+                yield path
+
+    def _get_path_list_bounds(self, root=None):
+        """
+        find the minimum and maximum valid paths of paths text file by stream, the same as `_tidy_fs`
+        --> if `root` is given, the paths within the excluded folders (under root) are skipped.
+        :return: (str, str); `None` if no valid path
+        """
+        min_path = max_path = None
+        try:
+            for path in self._iterate_path_list(self._path_list_file):
+                if not self._is_skip_pattern and not self._check_input_file_path(path):
+                    continue
+                if root is not None and self._in_excluded_folder(path, root):
+                    continue
+                if min_path is None or path < min_path:
+                    min_path = path
+                if max_path is None or path > max_path:
+                    max_path = path
+        except (OSError, EOFError):
+            raise ValueError('ERROR: input file cannot be read!')
+        return min_path, max_path
+
+    def _get_path_list_root(self):
+        """ find common root path of the valid paths of paths text file by stream """
+        min_path, max_path = self._get_path_list_bounds()
+        if min_path is None:
+            raise FileNotFoundError('ERROR: no file has been found!')
+        self._path_list_root = self._get_common_root(min_path, max_path)
+        if self._exclude_folder_matcher is None:
+            return self._path_list_root
+        # the folders are excluded within the common root of valid paths
+        min_path, max_path = self._get_path_list_bounds(self._path_list_root)
+        if min_path is None:
+            raise FileNotFoundError('ERROR: no file has been found!')
+        return self._get_common_root(min_path, max_path)
+
     def _read_fs(self):
         """
         read paths from text file: one line with one path
         else: only one input file
         """
         try:
-            lines = np.loadtxt(self.fp_input, dtype=str, comments=None, ndmin=1).tolist()
-        except Exception:
+            lines = list(self._iterate_path_list(self.fp_input))
+        except (OSError, EOFError):
             raise ValueError(f'ERROR: input file cannot be read!')
         common_path, fs = self._tidy_fs(lines)
         return common_path, fs
@@ -429,76 +2226,531 @@ class FileProcessing(object):
     def _run_callback(self, args):
         # custom callback function
         if self._callback_input_length == 0:
-            self.callback()
+            return self.callback()
         elif self._callback_input_length == 1:
-            self.callback(args)
+            return self.callback(args)
         else:
-            self.callback(*args)
+            return self.callback(*args)
+
+    async def _run_callback_async(self, args):
+        # custom callback function (coroutine or not)
+        result = self._run_callback(args)
+        if isawaitable(result):
+            await result
 
     def _callback_clean_paths(self, args):
-        # clean file path during callback
+        # count the produced files of output folder during callback, the empty folders are removed at the end
         if not self._single_args_mode:
             in_path, out_path = args
-            if not os.path.exists(out_path):
-                self._empty_file_counter += 1
-            if self._safe_division(self._empty_file_counter,
-                                   self._total_file_number) > self._stop_each_file_cleaning_ratio:
-                self._simplify_path(self.fp_output, out_path)
+            out_folder = os.path.dirname(out_path)
+            self._out_folder_counts[out_folder] = self._out_folder_counts.get(out_folder, 0) + os.path.exists(out_path)
+
+    def _count_paths(self, paths):
+        """ add counter if iterator mode """
+        for path in paths:
+            self._total_file_number += 1
+            yield path
+
+    def _process_batches(self, paths, callback_function):
+        """
+        process the files by batches with `do_batch`, a batch for each task:
+        --> the progress and callback are still for each file;
+        --> at most `max_pending` batches are submitted but unfinished.
+        """
+
+        def _batch_callback_function(batch, func):
+            if func.exception() is not None:
+                # the worker process is broken
+                results = [(x, self._format_error(func.exception())) for x in batch]
+            else:
+                results = func.result()
+            for result in results:
+                callback_function(*result)
+
+        worker_number = 1 if self.fp_cpu == 1 else self._cpu_count(self.fp_cpu)
+        batch_size = self.fp_batch_size
+        if not self._file_iterator_mode and batch_size > 0:
+            # share the files to all workers, if the files are not enough
+            share_size, extra = divmod(len(self.fp_paths), worker_number)
+            batch_size = min(batch_size, share_size + (extra > 0))
+        if self.fp_cpu == 1:
+            self._start_worker()
+            for batch in self._get_batches(paths, batch_size):
+                for result in self._do_batch_task(batch):
+                    callback_function(*result)
+                    self._raise_serial_failure(result)
+            return
+        if self.fp_multi_what in ['mp', 'imp', 'mpt', 'impt']:
+            executor = ProcessPoolExecutor(max_workers=worker_number, initializer=_initialize_worker,
+                                           initargs=(self._get_worker_obj(),))
+            batch_function = _do_batch_chunk
+        else:
+            executor = _WorkerThreadPool(worker_number, self)
+            batch_function = self._do_batch_task
+        max_pending = self._get_max_pending(worker_number)
+        with executor:
+            pending = set()
+            for batch in self._get_batches(paths, batch_size):
+                # wait the batches to be done if too many are pending
+                if len(pending) >= max_pending:
+                    _, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = executor.submit(batch_function, batch, time.time())
+                future.add_done_callback(fn=functools.partial(_batch_callback_function, batch))
+                pending.add(future)
+            concurrent.futures.wait(pending)
+
+    def _process_pipeline(self, paths, callback_function):
+        """
+        process with pipeline of stages `load` -> `process` -> `save`:
+        --> the I/O stages run within threads, the stage `process` runs within processes (threads for `mt` and `imt`);
+        --> the next files are loaded while the earlier files are processing, bounded by `max_pending`.
+        """
+
+        def _submit_stage(index, in_path, timing, *args):
+            stage, executor = stages[index]
+            if executor is compute_executor and is_process:
+                future = executor.submit(_do_pipeline_stage, stage, *args)
+            else:
+                future = executor.submit(self._do_stage, stage, *args)
+            future.add_done_callback(fn=functools.partial(_stage_callback_function, index, in_path, timing))
+
+        def _stage_callback_function(index, in_path, timing, func):
+            error = None
+            try:
+                if func.exception() is not None:
+                    error = self._format_error(func.exception())
+                else:
+                    result, worker_name, seconds = func.result()
+                    timing.append((worker_name, seconds))
+                    if index == 0:
+                        _submit_stage(1, in_path, timing, result)
+                        return
+                    elif index == 1:
+                        _submit_stage(2, in_path, timing, in_path, result)
+                        return
+            except Exception as e:
+                # such as the broken pool of processes
+                error = self._format_error(e)
+            try:
+                if error is not None:
+                    callback_function(in_path, error)
+                elif self._measure_mode:
+                    # timing: start time, then (worker, seconds) of each stage
+                    # metrics: worker of stage `process`, time of all stages, and the waiting between stages
+                    wall_time = sum(x[1] for x in timing[1:])
+                    total_time = time.perf_counter() - timing[0]
+                    callback_function(result, None, (timing[2][0], wall_time, None, max(total_time - wall_time, 0)))
+                else:
+                    callback_function(result)
+            finally:
+                pending.release()
+
+        is_process = self.fp_multi_what in ['mp', 'imp', 'mpt', 'impt'] and self.fp_cpu != 1
+        worker_number = 1 if self.fp_cpu == 1 else self._cpu_count(self.fp_cpu)
+        max_pending = self._get_max_pending(worker_number)
+        pending = threading.BoundedSemaphore(max_pending)
+        thread_number = max(self.fp_pipeline_thread_number, 1)
+        load_executor = _WorkerThreadPool(thread_number, self)
+        save_executor = _WorkerThreadPool(thread_number, self)
+        if is_process:
+            compute_executor = ProcessPoolExecutor(max_workers=worker_number, initializer=_initialize_worker,
+                                                   initargs=(self._get_worker_obj(),))
+        else:
+            compute_executor = _WorkerThreadPool(worker_number, self)
+        stages = [('load', load_executor), ('process', compute_executor), ('_save_output', save_executor)]
+        try:
+            for path in paths:
+                # wait the files to be saved if too many are pending
+                pending.acquire()
+                _submit_stage(0, path, [time.perf_counter()], path)
+            # wait all files to be saved
+            for _ in range(max_pending):
+                pending.acquire()
+        finally:
+            load_executor.shutdown()
+            compute_executor.shutdown()
+            save_executor.shutdown()
+
+    def _process_auto(self, paths, callback_function):
+        """
+        process with the adaptive number of active workers (`cpu_number` is `auto`):
+        --> the workers are started for the maximum number, but only the active number of tasks are submitted;
+        --> the active number is tuned by the throughput, CPU utilisation and available memory.
+        """
+
+        def _chunk_callback_function(chunk, func):
+            if func.exception() is not None:
+                # the worker process is broken
+                results = [(x, self._format_error(func.exception())) for x in chunk]
+            else:
+                results = func.result()
+            for result in results:
+                callback_function(*result)
+            tuner.add(len(chunk))
+
+        def _task_callback_function(func):
+            callback_function(*func.result())
+            tuner.add(1)
+
+        thread_number = self._get_thread_number()
+        if self.fp_multi_what in ['mp', 'imp', 'mpt', 'impt']:
+            # processes can be more than the CPU number (for I/O), but limited by the memory of processes
+            tuner = _WorkerTuner(os.cpu_count() * 4, os.cpu_count(), self.fp_auto_interval,
+                                 self.fp_auto_memory_reserve)
+            tuner.limit_by_memory(tuner.get_process_memory())
+            executor, chunk_function = self._get_process_executor(tuner.max_number)
+            chunk_size = 1
+            if thread_number > 1:
+                # hybrid mode: send the paths by chunks, to keep the threads of worker busy
+                chunk_size = self.fp_chunk_size if self.fp_chunk_size > 0 else thread_number
+        elif self.fp_multi_what in ['mt', 'imt']:
+            # threads for I/O: can be more than the CPU number
+            tuner = _WorkerTuner(max(os.cpu_count() * 4, 32), os.cpu_count(), self.fp_auto_interval,
+                                 self.fp_auto_memory_reserve)
+            executor = _WorkerThreadPool(tuner.max_number, self)
+            chunk_function = None
+            chunk_size = 1
+        else:
+            raise ValueError('ERROR: multi-what should be: multi-threading `mt` or `imt`, multi-processing `mp` or '
+                             '`imp`, or multi-processing with threads `mpt` or `impt`!')
+        try:
+            with executor:
+                pending = set()
+                for chunk in iter(lambda: list(itertools.islice(paths, chunk_size)), []):
+                    # wait the tasks to be done if the active workers are busy, the number is tuned meanwhile
+                    while len(pending) >= tuner.update():
+                        _, pending = concurrent.futures.wait(
+                            pending, timeout=self.fp_auto_interval, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                    if chunk_function is not None:
+                        future = executor.submit(chunk_function, chunk, time.time())
+                        future.add_done_callback(fn=functools.partial(_chunk_callback_function, chunk))
+                    else:
+                        future = executor.submit(self._do_task, chunk[0], True, time.time())
+                        future.add_done_callback(fn=_task_callback_function)
+                    pending.add(future)
+                concurrent.futures.wait(pending)
+        finally:
+            self._stop_workers()
+            self._auto_summary = tuner.get_summary()
+            print(f'<auto: {tuner.number} active workers (best: {tuner.best[1]} with '
+                  f'{tuner.best[0]:.1f} files/s, maximum: {tuner.max_number})>')
+
+    def _process_supervised(self, paths, callback_function, worker_number=None):
+        """
+        process with supervised workers for timeout:
+        --> the stuck worker will be killed (or abandoned for thread) and replaced;
+        --> the failed file will be retried later with backoff.
+        """
+
+        def _handle_result(task, result):
+            in_path, attempt = task
+            error = result[1]
+            if error is not None and attempt < self.fp_retry_number:
+                retry_time = time.time() + self._get_retry_delay(attempt)
+                heapq.heappush(retries, (retry_time, next(order), in_path, attempt + 1))
+            else:
+                callback_function(*result)
+
+        is_process = self.fp_multi_what in ['mp', 'imp', 'mpt', 'impt']
+        if worker_number is None:
+            # the threads of hybrid modes cannot be killed, they are replaced by processes
+            worker_number = 1 if self.fp_cpu == 1 else self._cpu_count(self.fp_cpu) * self._get_thread_number()
+        fp_obj = self._get_worker_obj() if is_process else self
+        iterator = iter(paths)
+        # retries: heap of (ready time, order, path, attempt)
+        retries = []
+        order = itertools.count()
+        idle_workers = [_SupervisedWorker(fp_obj, is_process) for _ in range(worker_number)]
+        busy_workers = {}
+        try:
+            while True:
+                # send tasks to idle workers
+                while idle_workers:
+                    if retries and retries[0][0] <= time.time():
+                        _, _, in_path, attempt = heapq.heappop(retries)
+                    else:
+                        in_path = next(iterator, None)
+                        attempt = 0
+                        if in_path is None:
+                            break
+                    worker = idle_workers.pop()
+                    worker.submit((in_path, attempt), self.fp_timeout)
+                    busy_workers[worker.connection] = worker
+                if not busy_workers:
+                    if not retries:
+                        break
+                    time.sleep(max(retries[0][0] - time.time(), 0))
+                    continue
+                # wait results until the nearest deadline or retry
+                wake_time = min(x.deadline for x in busy_workers.values())
+                if retries:
+                    wake_time = min(wake_time, retries[0][0])
+                for connection in multiprocessing.connection.wait(list(busy_workers),
+                                                                  timeout=max(wake_time - time.time(), 0)):
+                    worker = busy_workers.pop(connection)
+                    try:
+                        result = connection.recv()
+                        idle_workers.append(worker)
+                    except (EOFError, OSError):
+                        # the worker exits unexpectedly (such as out of memory)
+                        result = (worker.task[0], 'WorkerError: worker exited unexpectedly')
+                        worker.kill()
+                        idle_workers.append(_SupervisedWorker(fp_obj, is_process))
+                    _handle_result(worker.task, result)
+                # kill and replace stuck workers
+                for connection, worker in list(busy_workers.items()):
+                    if worker.deadline <= time.time():
+                        del busy_workers[connection]
+                        worker.kill()
+                        idle_workers.append(_SupervisedWorker(fp_obj, is_process))
+                        _handle_result(worker.task, (worker.task[0], f'TimeoutError: {self.fp_timeout} seconds'))
+        finally:
+            for worker in busy_workers.values():
+                worker.kill()
+            for worker in idle_workers:
+                worker.stop()
 
     def _process_mp_mt(self):
-        def _callback_function(args):
+        def _callback_function(args, error=None, metrics=None):
             # update p_bar
             p_bar.update()
+            if error is not None:
+                self._record_failure(args, error)
+                return
+            self._record_metrics(args, metrics)
             self._run_callback(args)
             self._callback_clean_paths(args)
+            self._record_done(args)
+
+        def _chunk_callback_function(chunk, func):
+            if func.exception() is not None:
+                # the worker process is broken
+                results = [(x, self._format_error(func.exception())) for x in chunk]
+            else:
+                results = func.result()
+            for result in results:
+                _callback_function(*result)
 
         self._update_paths_len()
         with tqdm(total=len(self.fp_paths), dynamic_ncols=True) as p_bar:
-            if self.fp_cpu != 1:
-                if self.fp_multi_what == 'mp':
-                    executor_class = ProcessPoolExecutor
+            if self._pipeline_mode:
+                try:
+                    self._process_pipeline(self.fp_paths, _callback_function)
+                finally:
+                    self._stop_workers()
+            elif self._batch_mode:
+                try:
+                    self._process_batches(self.fp_paths, _callback_function)
+                finally:
+                    self._stop_workers()
+            elif self.fp_timeout is not None:
+                try:
+                    self._process_supervised(self.fp_paths, _callback_function)
+                finally:
+                    self._stop_workers()
+            elif self._auto_mode:
+                self._process_auto(iter(self.fp_paths), _callback_function)
+            elif self.fp_cpu != 1:
+                worker_number = self._cpu_count(self.fp_cpu)
+                if self.fp_multi_what in ['mp', 'mpt']:
+                    executor, chunk_function = self._get_process_executor(worker_number)
+                    with executor:
+                        for chunk in self._get_chunks(worker_number):
+                            future = executor.submit(chunk_function, chunk, time.time())
+                            future.add_done_callback(fn=functools.partial(_chunk_callback_function, chunk))
                 elif self.fp_multi_what == 'mt':
-                    executor_class = ThreadPoolExecutor
+                    try:
+                        with _WorkerThreadPool(worker_number, self) as executor:
+                            for f in self.fp_paths:
+                                future = executor.submit(self._do_task, f, True, time.time())
+                                future.add_done_callback(fn=lambda func: _callback_function(*func.result()))
+                    finally:
+                        self._stop_workers()
                 else:
-                    raise ValueError('ERROR: multi-what should be: multi-threading `mt`, or multi-processing `mp`!')
-                with executor_class(max_workers=self._cpu_count(self.fp_cpu)) as executor:
-                    for f in self.fp_paths:
-                        future = executor.submit(self._do_multi_mapping, f)
-                        future.add_done_callback(fn=lambda func: _callback_function(func.result()))
+                    raise ValueError('ERROR: multi-what should be: multi-threading `mt`, multi-processing `mp`, '
+                                     'or multi-processing with threads `mpt`!')
             else:
-                for f in self.fp_paths:
-                    result = self._do_multi_mapping(f)
-                    _callback_function(result)
+                self._start_worker()
+                try:
+                    for f in self.fp_paths:
+                        result = self._do_task(f)
+                        _callback_function(*result)
+                        self._raise_serial_failure(result)
+                finally:
+                    self._stop_workers()
 
     def _process_imp_imt(self):
-        def _callback_function(args):
+        def _callback_function(args, error=None, metrics=None):
             # update p_bar
             p_bar.update()
+            if error is not None:
+                self._record_failure(args, error)
+                return
+            self._record_metrics(args, metrics)
             self._run_callback(args)
             self._callback_clean_paths(args)
+            self._record_done(args)
+
+        def _chunk_callback_function(chunk, func):
+            if func.exception() is not None:
+                # the worker process is broken
+                results = [(x, self._format_error(func.exception())) for x in chunk]
+            else:
+                results = func.result()
+            for result in results:
+                _callback_function(*result)
 
         with tqdm(desc="Processing", dynamic_ncols=True) as p_bar:
-            if self.fp_cpu != 1:
-                if self.fp_multi_what == 'imp':
-                    executor_class = ProcessPoolExecutor
+            paths = self._count_paths(self._iterate_paths())
+            if self._pipeline_mode:
+                try:
+                    self._process_pipeline(paths, _callback_function)
+                finally:
+                    self._stop_workers()
+            elif self._batch_mode:
+                try:
+                    self._process_batches(paths, _callback_function)
+                finally:
+                    self._stop_workers()
+            elif self.fp_timeout is not None:
+                try:
+                    self._process_supervised(paths, _callback_function)
+                finally:
+                    self._stop_workers()
+            elif self._auto_mode:
+                self._process_auto(paths, _callback_function)
+            elif self.fp_cpu != 1:
+                worker_number = self._cpu_count(self.fp_cpu)
+                thread_number = self._get_thread_number()
+                if self.fp_multi_what in ['imp', 'impt']:
+                    executor, chunk_function = self._get_process_executor(worker_number)
+                    chunk_size = 1
+                    if thread_number > 1:
+                        # hybrid mode: send the paths by chunks, to keep the threads of worker busy
+                        chunk_size = self.fp_chunk_size if self.fp_chunk_size > 0 else thread_number
                 elif self.fp_multi_what == 'imt':
-                    executor_class = ThreadPoolExecutor
+                    executor = _WorkerThreadPool(worker_number, self)
+                    chunk_function = None
+                    chunk_size = 1
                 else:
-                    raise ValueError('ERROR: multi-what iterator mode should be:'
-                                     'multi-threading `imt`, or multi-processing `imp`!')
-                with executor_class(max_workers=self._cpu_count(self.fp_cpu)) as executor:
-                    futures = []
-                    for filename in self._find_fs_iterator():
+                    raise ValueError('ERROR: multi-what iterator mode should be: multi-threading `imt`, '
+                                     'multi-processing `imp`, or multi-processing with threads `impt`!')
+                # the maximum pending files, counted by chunks
+                max_pending = max(self._get_max_pending(worker_number * thread_number) // chunk_size, 1)
+                try:
+                    with executor:
+                        pending = set()
+                        for chunk in iter(lambda: list(itertools.islice(paths, chunk_size)), []):
+                            # wait the tasks to be done if too many are pending
+                            if len(pending) >= max_pending:
+                                _, pending = concurrent.futures.wait(
+                                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                                )
+                            if chunk_function is not None:
+                                future = executor.submit(chunk_function, chunk, time.time())
+                                future.add_done_callback(fn=functools.partial(_chunk_callback_function, chunk))
+                            else:
+                                future = executor.submit(self._do_task, chunk[0], True, time.time())
+                                future.add_done_callback(fn=lambda func: _callback_function(*func.result()))
+                            pending.add(future)
+                        concurrent.futures.wait(pending)
+                finally:
+                    self._stop_workers()
+            else:
+                self._start_worker()
+                try:
+                    for f in paths:
+                        result = self._do_task(f)
+                        _callback_function(*result)
+                        self._raise_serial_failure(result)
+                finally:
+                    self._stop_workers()
+
+    @staticmethod
+    async def _iterate_async(paths, batch_size=256):
+        """ get paths from blocking iterator within thread, batch by batch """
+        loop = asyncio.get_running_loop()
+        iterator = iter(paths)
+        while True:
+            batch = await loop.run_in_executor(None, lambda: list(itertools.islice(iterator, batch_size)))
+            if not batch:
+                break
+            for path in batch:
+                yield path
+
+    async def _process_async(self):
+        async def _callback_function(args, error=None, metrics=None):
+            # update p_bar
+            p_bar.update()
+            if error is not None:
+                self._record_failure(args, error)
+                return
+            self._record_metrics(args, metrics)
+            await self._run_callback_async(args)
+            self._callback_clean_paths(args)
+            self._record_done(args)
+
+        async def _task_function(path):
+            try:
+                await _callback_function(*await self._do_task_async(path, executor))
+            finally:
+                semaphore.release()
+
+        def _discard_task(task):
+            # keep the failed tasks to raise the exception at the end
+            if not task.cancelled() and task.exception() is None:
+                tasks.discard(task)
+
+        async def _submit_function(path):
+            # wait if too many tasks are running
+            await semaphore.acquire()
+            task = asyncio.ensure_future(_task_function(path))
+            tasks.add(task)
+            task.add_done_callback(_discard_task)
+
+        def _supervised_callback_function(*result):
+            # the callback runs on event loop, the supervisor thread waits for it
+            asyncio.run_coroutine_threadsafe(_callback_function(*result), loop).result()
+
+        semaphore = asyncio.Semaphore(self.fp_async_number)
+        tasks = set()
+        loop = asyncio.get_running_loop()
+        # blocking `do` with timeout: the stuck thread cannot be cancelled, it is abandoned and replaced
+        is_supervised = not iscoroutinefunction(self.do) and self.fp_timeout is not None
+        if is_supervised:
+            executor = None
+        elif iscoroutinefunction(self.do):
+            # the event loop is the only worker
+            executor = None
+            self._start_worker()
+        else:
+            # blocking `do` runs within threads
+            executor = _WorkerThreadPool(self.fp_async_number, self)
+        if self._file_iterator_mode:
+            p_bar = tqdm(desc="Processing", dynamic_ncols=True)
+        else:
+            self._update_paths_len()
+            p_bar = tqdm(total=len(self.fp_paths), dynamic_ncols=True)
+        with p_bar:
+            try:
+                if is_supervised:
+                    paths = self._count_paths(self._iterate_paths()) if self._file_iterator_mode else self.fp_paths
+                    await loop.run_in_executor(None, self._process_supervised, paths,
+                                               _supervised_callback_function, self.fp_async_number)
+                elif self._file_iterator_mode:
+                    async for f in self._iterate_async(self._iterate_paths()):
                         # add counter if iterator mode
                         self._total_file_number += 1
-                        future = executor.submit(self._do_multi_mapping, filename)
-                        future.add_done_callback(fn=lambda func: _callback_function(func.result()))
-                        futures.append(future)
-                    concurrent.futures.wait(futures)
-            else:
-                for f in self._find_fs_iterator():
-                    result = self._do_multi_mapping(f)
-                    _callback_function(result)
+                        await _submit_function(f)
+                else:
+                    for f in self.fp_paths:
+                        await _submit_function(f)
+                await asyncio.gather(*tasks)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+                self._stop_workers()
 
     def _do_once(self):
         """
@@ -513,7 +2765,14 @@ class FileProcessing(object):
                 attributes.append(self.fp_output)
             else:
                 raise AttributeError('ERROR: output format should match at single process!')
-        self.do(*attributes)
+        if self._pipeline_mode:
+            result = self.save(self.process(self.load(self.fp_input)), attributes[-1])
+        elif self._batch_mode:
+            result = self.do_batch(*[[x] for x in attributes])
+        else:
+            result = self.do(*attributes)
+        if isawaitable(result):
+            asyncio.run(result)
         return attributes
 
     def do(self, *args):
@@ -529,8 +2788,53 @@ class FileProcessing(object):
         """
         pass
 
+    def do_batch(self, *args):
+        """
+        process a batch of files at once (such as vectorized computing on small files), rewrite it rather than `do`.
+        --> the arguments are lists: `in_paths` and `out_paths` (or only `in_paths` if no output).
+        """
+        pass
+
+    def load(self, in_path):
+        """
+        the first stage of pipeline (within threads): read the input file, the result is sent to `process`.
+        --> the pipeline is used if `process` is rewritten rather than `do`.
+        """
+        return in_path
+
+    def process(self, data):
+        """
+        the second stage of pipeline (within processes): compute the loaded data, the result is sent to `save`.
+        """
+        return data
+
+    def save(self, data, out_path):
+        """
+        the last stage of pipeline (within threads): write the result, `out_path` is the input path if no output.
+        """
+        pass
+
     def before(self):
         """
         do something just before multiprocessing
         """
         pass
+
+    def cost(self, in_path):
+        """
+        the cost to process the file for `schedule`, default: file size.
+        """
+        return os.path.getsize(in_path) if os.path.isfile(in_path) else 0
+
+    def before_worker(self):
+        """
+        do something once when each worker (process or thread) starts,
+        --> keep the state (model, connection...) in `self.fp_worker_state` for function `do`.
+        """
+        pass
+
+    def after_worker(self):
+        """
+        do something once when each worker (process or thread) stops, to release `self.fp_worker_state`.
+        """
+        pass
@@ -32,6 +32,32 @@ class Template(FileProcessing):
     #    """
     #    pass
 
+    # or pipeline of stages, rather than `do`
+    # def load(self, in_path):
+    #    """
+    #    (optional) read the input file within threads
+    #    """
+    #    return in_path
+    #
+    # def process(self, data):
+    #    """
+    #    compute the loaded data within processes
+    #    """
+    #    return data
+    #
+    # def save(self, data, out_path):
+    #    """
+    #    write the result within threads
+    #    """
+    #    pass
+
+    # or process a batch of files at once, rather than `do`
+    # def do_batch(self, in_paths, out_paths):
+    #    """
+    #    implement this method for a batch of files
+    #    """
+    #    pass
+
     def callback(self, in_path, out_path):
         """
         (optional) implement this method for callback operation
@@ -48,6 +74,25 @@ class Template(FileProcessing):
         """
         pass
 
+    def cost(self, in_path):
+        """
+        (optional) the cost to process the file for `schedule`, default: file size
+        """
+        return super().cost(in_path)
+
+    def before_worker(self):
+        """
+        (optional) do something once when each worker starts
+        --> keep the state in `self.fp_worker_state` for function `do`
+        """
+        pass
+
+    def after_worker(self):
+        """
+        (optional) do something once when each worker stops
+        """
+        pass
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='xxx xxx xxx')
@@ -57,14 +102,21 @@ if __name__ == '__main__':
     fp_group.add_argument('--in_format', '-if', type=str, help='the input format', default='xxx')
     fp_group.add_argument('--output', '-o', type=str, help='the output folder/file')
     fp_group.add_argument('--out_format', '-of', type=str, help='the output format', default='yyy')
-    fp_group.add_argument('--cpu_number', '-j', type=int, help='cpu number of processing', default=0)
+    fp_group.add_argument('--cpu_number', '-j', type=lambda x: x if x == 'auto' else int(x),
+                          help='cpu number of processing, or `auto` to tune while processing', default=0)
     fp_group.add_argument('--multi_what', '-x', type=str,
-                          help='4 mode supported:'
-                               'a. multi-threading: `mt`,'
-                               'b. multi-processing: `mp` (default),'
-                               'c. iterator multi-threading: `imt`,'
-                               'd. iterator multi-processing: `imp`',
+                          help='8 modes supported: '
+                               'a. multi-threading: `mt`, '
+                               'b. multi-processing: `mp` (default), '
+                               'c. iterator multi-threading: `imt`, '
+                               'd. iterator multi-processing: `imp`, '
+                               'e. asynchronous I/O: `async`, '
+                               'f. iterator asynchronous I/O: `iasync`, '
+                               'g. multi-processing with threads: `mpt`, '
+                               'h. iterator multi-processing with threads: `impt`',
                           default=None)
+    fp_group.add_argument('--thread_number', '-t', type=int,
+                          help='the number of threads within each process for `mpt` and `impt`', default=4)
     fp_group.add_argument('--logger_level', '-log', type=str,
                           help='define the logger level, if `None`: no log file generated', default='info')
 